@@ -124,6 +124,19 @@ in
         '';
       };
 
+      blobs_directory = lib.mkOption {
+        type = with lib.types; nullOr path;
+        default =
+          let
+            blobs = cfg.secrets.src_directory + "/blobs";
+          in
+          if builtins.pathExists blobs then blobs else null;
+        description = ''
+          The directory containing the stream-encrypted content of binary secrets,
+          or null if there are no binary secrets.
+        '';
+      };
+
       dest_directory = lib.mkOption {
         type = lib.types.str;
         description = ''
@@ -398,28 +398,27 @@ in
             ''
               echo "decrypting the server secrets..."
               ${lib.concatMapStringsSep "\n" mkRemoveOldDir cfg.secrets.old_dest_directories}
-              if [ -e "${cfg.secrets.dest_directory}" ]; then
-                ${pkgs.coreutils}/bin/rm --one-file-system \
-                                         --recursive \
-                                         --force \
-                                         "${cfg.secrets.dest_directory}"
-              fi
               ${pkgs.coreutils}/bin/mkdir --parent "${cfg.secrets.dest_directory}"
 
+              # The secrets are written to a staging directory, which then atomically
+              # replaces the destination directory, unless neither the encrypted
+              # secrets nor the decrypted files changed since the last run.
+              # The files are owned by root and we use an ACL to give access
+              # to members of the wheel and docker groups.
               ${pkgs.ocb-nixostools}/bin/decrypt_server_secrets \
                 --server_name "${config.settings.system.secrets.serverName}" \
                 --secrets_path "${cfg.secrets.src_file}" \
                 --output_path "${cfg.secrets.dest_directory}" \
-                --private_key_file "${cfg.private_key}"
-
-              # The directory is owned by root
-              ${pkgs.coreutils}/bin/chown --recursive root:root "${cfg.secrets.dest_directory}"
-              ${pkgs.coreutils}/bin/chmod --recursive u=rwX,g=,o= "${cfg.secrets.dest_directory}"
-              # Use an ACL to give access to members of the wheel and docker groups
-              ${pkgs.acl}/bin/setfacl \
-                --recursive \
-                --set "${acl}" \
-                "${cfg.secrets.dest_directory}"
+                --private_key_file "${cfg.private_key}" \
+                ${
+                  lib.optionalString (
+                    cfg.secrets.blobs_directory != null
+                  ) ''--blobs_directory "${cfg.secrets.blobs_directory}"''
+                } \
+                --skip_unchanged \
+                --atomic \
+                --owner root:root \
+                --acl "${acl}"
               echo "decrypted the server secrets"
             '';
         };
@@ -438,27 +437,22 @@ in
             in
             ''
               echo "extracting the server configs..."
-              if [ -e "${cfg.app_configs.dest_directory}" ]; then
-                ${pkgs.coreutils}/bin/rm --one-file-system \
-                                        --recursive \
-                                        --force \
-                                        "${cfg.app_configs.dest_directory}"
-              fi
               ${pkgs.coreutils}/bin/mkdir --parent "${cfg.app_configs.dest_directory}"
 
+              # Only the files whose content changed get (atomically) replaced,
+              # and stale files get removed. The changed paths are recorded in a
+              # .changes.json file next to the destination directory, so that the apps
+              # reading the configs can be reloaded only when their files changed.
+              # The files and folders, the destination directory included, are owned
+              # by root and we use an ACL to give access to members of the allowed
+              # groups. These permissions are also fixed on unchanged files and folders.
               ${pkgs.ocb-nixostools}/bin/extract_server_app_configs \
                 --server_name "${config.networking.hostName}" \
                 --configs_path "${cfg.app_configs.src_file}" \
-                --output_path "${cfg.app_configs.dest_directory}"
-
-              # The directory is owned by root
-              ${pkgs.coreutils}/bin/chown --recursive root:root "${cfg.app_configs.dest_directory}"
-              ${pkgs.coreutils}/bin/chmod --recursive u=rwX,g=,o= "${cfg.app_configs.dest_directory}"
-              # Use an ACL to give access to members of the wheel and docker groups
-              ${pkgs.acl}/bin/setfacl \
-                --recursive \
-                --set "${acl}" \
-                "${cfg.app_configs.dest_directory}"
+                --output_path "${cfg.app_configs.dest_directory}" \
+                --sync \
+                --owner root:root \
+                --acl "${acl}"
               echo "extracted the server configs"
             '';
         };
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Benchmark for the dedup format of the generated app configs, comparing the
+# size of the generated file and the time a host needs to extract its configs
+# with the plain format, for configs shared by many servers.
+# Both formats need to give the same configs for every server.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/app_configs_dedup.py
+import argparse
+import time
+
+from nixostools import config_lib, generate_server_app_configs, yaml_lib
+from nixostools.generate_server_app_configs import DEDUP_FORMAT, ServerConfigData
+
+
+def make_configs(n_servers: int, n_shared: int, shared_size: int) -> list:
+    shared = {
+        f"shared-{j:03d}": {
+            "path": f"app-{j:03d}/docker-compose.yml",
+            "content": "".join(
+                f"  setting_{k}: value {k} of shared config {j}\n"
+                for k in range(shared_size // 40)
+            ),
+        }
+        for j in range(n_shared)
+    }
+    return [
+        ServerConfigData(
+            server_name=f"server-{i:04d}",
+            # A copy for every server, like invert_server_items makes,
+            # otherwise PyYAML would write the shared configs as aliases
+            configs={
+                **{name: dict(config) for name, config in shared.items()},
+                "host.env": {"path": "host.env", "content": f"HOST=server-{i:04d}\n"},
+            },
+        )
+        for i in range(n_servers)
+    ]
+
+
+def timed(fn) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start, result)
+
+
+def extract(text: str, server_name: str) -> object:
+    content = yaml_lib.safe_load(text)
+    if config_lib.is_dedup_configs(content):
+        return config_lib.dedup_server_configs(content, server_name)
+    return content.get(server_name)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", type=int, default=300)
+    parser.add_argument("--shared_configs", type=int, default=5)
+    parser.add_argument("--shared_size", type=int, default=4096)
+    args = parser.parse_args()
+
+    configs = make_configs(args.servers, args.shared_configs, args.shared_size)
+    plain = yaml_lib.safe_dump(
+        {data.server_name: data.configs for data in configs}, literal=True
+    )
+    dedup = yaml_lib.safe_dump(
+        generate_server_app_configs.dedup_configs(configs), literal=True
+    )
+    server_name = configs[-1].server_name
+    (plain_time, plain_configs) = timed(lambda: extract(plain, server_name))
+    (dedup_time, dedup_configs) = timed(lambda: extract(dedup, server_name))
+    assert plain_configs == dedup_configs, "the extracted configs differ"
+
+    print(f"{'format':>8} {'MB':>8} {'extract (s)':>12}")
+    print(f"{'plain':>8} {len(plain) / 1e6:>8.2f} {plain_time:>12.3f}")
+    print(f"{DEDUP_FORMAT:>8} {len(dedup) / 1e6:>8.2f} {dedup_time:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
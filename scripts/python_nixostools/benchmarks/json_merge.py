@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Benchmark for ocb_nixos_lib.merge_all, the merge of the tunnels.d JSON files
+# used by read_json_configs, against folding the files pairwise with deep_merge.
+# The time per host entry of merge_all should stay flat as the number of files grows.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/json_merge.py
+import argparse
+import time
+from functools import reduce
+
+from nixostools import ocb_nixos_lib
+
+
+def make_files(n_files: int, n_hosts: int) -> list[dict]:
+    return [
+        {
+            "tunnels": {
+                "per-host": {
+                    f"host-{i:05d}": {
+                        "remote_forward_port": 6000 + i,
+                        "public_key": f"ssh-ed25519 {'A' * 68} root@host-{i:05d}",
+                        "generate_secrets": i % 7 != 0,
+                        "groups": ["all", f"group-{i % 10}"],
+                    }
+                    for i in range(f, n_hosts, n_files)
+                },
+                "reverse_tunnels": [f"relay-{f}"],
+            }
+        }
+        for f in range(n_files)
+    ]
+
+
+def timed(fn) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start, result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=5000)
+    parser.add_argument("--files", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    print(
+        f"{'files':>6} {'hosts':>6} {'fold (s)':>9} {'k-way (s)':>10} "
+        + f"{'us/host':>8} {'speedup':>8}"
+    )
+    for n_files in args.files:
+        files = make_files(n_files, args.hosts)
+        (fold, folded) = timed(lambda: reduce(ocb_nixos_lib.deep_merge, files, {}))
+        (kway, merged) = timed(lambda: ocb_nixos_lib.merge_all(files))
+        assert folded == merged
+        print(
+            f"{n_files:>6} {args.hosts:>6} {fold:>9.3f} {kway:>10.3f} "
+            + f"{kway / args.hosts * 1e6:>8.2f} {fold / kway:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
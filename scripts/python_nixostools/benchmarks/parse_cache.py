@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Benchmark for the parse cache of generate_server_app_configs: the time to
+# read a large tree of configs files without the cache, with an empty (cold)
+# cache and with a cache holding every file (warm), through read_configs_files
+# like the command does.
+# The content read through the cache needs to be the same as without it.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/parse_cache.py
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+from collections.abc import Callable, Mapping
+
+from nixostools import generate_server_app_configs, ocb_nixos_lib, yaml_lib
+
+
+def write_configs_file(path: str, index: int, n_servers: int) -> None:
+    configs = {
+        f"config-{index:04d}-{j}": {
+            "path": f"app-{index:04d}/config-{j}.env",
+            "content": "".join(
+                f"SETTING_{k}=value {k} of config {j}\n" for k in range(10)
+            ),
+            "servers": [
+                f"server-{(index * 7 + j * 13 + k) % n_servers:04d}" for k in range(5)
+            ],
+        }
+        for j in range(3)
+    }
+    with open(path, "w") as f:
+        yaml_lib.safe_dump({"configs": configs}, f, literal=True)
+
+
+# Return the median time in seconds of the given run, and its latest result.
+def measure(run: Callable[[], Mapping], runs: int) -> tuple[float, Mapping]:
+    times = []
+    result: Mapping = {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run()
+        times.append(time.perf_counter() - start)
+    return (statistics.median(times), result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--servers", type=int, default=300)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        configs_directory = os.path.join(directory, "configs")
+        cache_path = os.path.join(directory, "parse.sqlite")
+        os.makedirs(configs_directory)
+        for i in range(args.files):
+            path = os.path.join(configs_directory, f"app-{i:04d}-configs.yml")
+            write_configs_file(path, i, args.servers)
+        files = generate_server_app_configs.find_configs_files(configs_directory)
+
+        def without_cache() -> Mapping:
+            return generate_server_app_configs.read_configs_files(files)
+
+        def with_cache() -> Mapping:
+            with ocb_nixos_lib.open_parse_cache(cache_path) as parse_cache:
+                return generate_server_app_configs.read_configs_files(
+                    files, parse_cache
+                )
+
+        def cold_cache() -> Mapping:
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            return with_cache()
+
+        (plain, expected) = measure(without_cache, args.runs)
+        (cold, cold_result) = measure(cold_cache, args.runs)
+        (warm, warm_result) = measure(with_cache, args.runs)
+        assert cold_result == expected, "the cold cache result differs"
+        assert warm_result == expected, "the warm cache result differs"
+
+    print(f"{'':>8} {'median (s)':>11} {'per file (us)':>14}")
+    for name, seconds in [("no cache", plain), ("cold", cold), ("warm", warm)]:
+        print(f"{name:>8} {seconds:>11.3f} {seconds / args.files * 1e6:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Benchmark for ocb_nixos_lib.invert_server_items, the server -> items inversion
+# used by encrypt_server_secrets and generate_server_app_configs.
+# The time per (item, server) grant should stay flat as the number of items grows.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/server_inversion.py
+import argparse
+import random
+import time
+
+from nixostools import ocb_nixos_lib
+
+
+def make_entries(
+    n_items: int, n_servers: int, servers_per_item: int
+) -> list[tuple[str, list[str], dict]]:
+    rng = random.Random(n_items)
+    servers = [f"server-{i:04d}" for i in range(n_servers)]
+    return [
+        (
+            f"secret-{i:05d}",
+            rng.sample(servers, servers_per_item),
+            {"path": f"secret-{i:05d}", "content": "x" * 64},
+        )
+        for i in range(n_items)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", type=int, default=1000)
+    parser.add_argument("--servers_per_item", type=int, default=100)
+    parser.add_argument(
+        "--items", type=int, nargs="+", default=[1250, 2500, 5000, 10000]
+    )
+    args = parser.parse_args()
+
+    print(f"{'items':>8} {'servers':>8} {'grants':>10} {'seconds':>8} {'ns/grant':>9}")
+    for n_items in args.items:
+        entries = make_entries(n_items, args.servers, args.servers_per_item)
+        grants = n_items * args.servers_per_item
+        start = time.perf_counter()
+        result = ocb_nixos_lib.invert_server_items(entries, lambda s, i: (s, i))
+        elapsed = time.perf_counter() - start
+        assert sum(len(items) for _, items in result) == grants
+        print(
+            f"{n_items:>8} {len(result):>8} {grants:>10} "
+            + f"{elapsed:>8.3f} {elapsed / grants * 1e9:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
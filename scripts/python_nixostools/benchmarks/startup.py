@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Benchmark for the startup time of the commands that run while a host boots,
+# measured with python -X importtime through the nixostools dispatcher.
+# Only the imports made after the interpreter's own startup (site) are counted,
+# and the run fails if a command imports more than the budget, or if it
+# imports the module of another subcommand.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/startup.py
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+
+from nixostools import cli
+
+# The commands that run in the systemd services at boot, see modules/system.nix
+BOOT_COMMANDS = ["decrypt_server_secrets", "extract_server_app_configs"]
+
+RUN_COMMAND = "from nixostools import cli; cli.main()"
+
+# A line of the -X importtime output: self and cumulative time in microseconds,
+# and the module name, indented by two spaces per level of nesting.
+IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)$")
+
+
+# Return the cumulative import time in microseconds of every module
+# imported after site, and the names of these modules.
+def import_times(command: str) -> tuple[int, list[str]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", RUN_COMMAND, command, "--help"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = [
+        (int(match[1]), len(match[2]), match[3])
+        for match in map(IMPORT_TIME.match, result.stderr.splitlines())
+        if match
+    ]
+    names = [name for (_, _, name) in imports]
+    after_site = imports[names.index("site") + 1 :] if "site" in names else imports
+    total = sum(cumulative for (cumulative, depth, _) in after_site if depth == 0)
+    return (total, [name for (_, _, name) in after_site])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", nargs="+", default=BOOT_COMMANDS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget_ms",
+        type=float,
+        default=80,
+        help="maximum median import time of a command, in milliseconds",
+    )
+    args = parser.parse_args()
+
+    print(f"{'command':>28} {'median (ms)':>12} {'min (ms)':>9} {'modules':>8}")
+    failures = []
+    for command in args.commands:
+        runs = [import_times(command) for _ in range(args.runs)]
+        times = [total / 1000 for (total, _) in runs]
+        modules = runs[0][1]
+        median = statistics.median(times)
+        print(f"{command:>28} {median:>12.1f} {min(times):>9.1f} {len(modules):>8}")
+        if median > args.budget_ms:
+            failures.append(f"{command} takes {median:.1f} ms to import")
+        failures.extend(
+            f"{command} imports {cli.SUBCOMMANDS[other]}"
+            for other in cli.SUBCOMMANDS
+            if other != command and cli.SUBCOMMANDS[other] in modules
+        )
+    if failures:
+        raise SystemExit("\n".join(["Over budget:", *failures]))
+
+
+if __name__ == "__main__":
+    main()
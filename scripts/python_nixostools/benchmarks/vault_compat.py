@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Check of the native Ansible Vault codec of ansible_vault_lib against files
+# produced by ansible-vault: a 1.1 file and a 1.2 file with a vault ID, both
+# encrypting vault_fixtures/plaintext.yml with the password below, e.g.
+#   ansible-vault encrypt --vault-password-file <file> \
+#     --output vault-1.1.yml plaintext.yml
+#   ansible-vault encrypt --vault-id test@<file> --output vault-1.2.yml plaintext.yml
+# It also checks that the files we encrypt decrypt again, and, when Ansible
+# is installed, that Ansible itself decrypts them.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/vault_compat.py
+import os
+
+from nixostools import ansible_vault_lib
+
+PASSWORD = "nixostools-vault-test"
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vault_fixtures")
+VAULT_FILES = ["vault-1.1.yml", "vault-1.2.yml"]
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def fails_to_decrypt(passwd: str, name: str, content: bytes) -> bool:
+    try:
+        ansible_vault_lib.vault_decrypt(passwd, name, content)
+    except Exception:
+        return True
+    return False
+
+
+def main() -> None:
+    if not ansible_vault_lib.HAS_CRYPTOGRAPHY:
+        raise SystemExit("The native codec needs the cryptography package.")
+    plaintext = read_fixture("plaintext.yml")
+    failures = []
+
+    for name in VAULT_FILES:
+        content = read_fixture(name)
+        if ansible_vault_lib.vault_decrypt(PASSWORD, name, content) != plaintext:
+            failures.append(f"{name} does not decrypt to plaintext.yml")
+        if not fails_to_decrypt("wrong password", name, content):
+            failures.append(f"{name} decrypts with a wrong password")
+
+    encrypted = ansible_vault_lib.vault_encrypt(PASSWORD, plaintext)
+    (header, *lines) = encrypted.splitlines()
+    if header != b"$ANSIBLE_VAULT;1.1;AES256":
+        failures.append(f"unexpected header {header!r}")
+    if any(len(line) > ansible_vault_lib.VAULT_LINE_WIDTH for line in lines):
+        failures.append("the encrypted lines are too long")
+    if ansible_vault_lib.vault_decrypt(PASSWORD, "encrypted", encrypted) != plaintext:
+        failures.append("vault_encrypt does not round-trip")
+
+    try:
+        ansible_lib = ansible_vault_lib.ansible_vault(PASSWORD)
+    except ImportError:
+        print("Ansible is not installed, skipping the check with Ansible.")
+    else:
+        if ansible_lib.decrypt(encrypted) != plaintext:
+            failures.append("Ansible does not decrypt the output of vault_encrypt")
+
+    if failures:
+        raise SystemExit("\n".join(["Vault codec check failed:", *failures]))
+    print(f"The vault codec decrypts {', '.join(VAULT_FILES)} and round-trips.")
+
+
+if __name__ == "__main__":
+    main()
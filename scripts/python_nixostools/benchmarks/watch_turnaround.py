@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Benchmark for generate_server_app_configs --watch: the time from the change
+# of a single configs file in a large tree to the rewritten output file.
+# Like the command, it reads the configs files through the parse cache, and
+# also measures the initial run with a cold and with a warm cache.
+# The output after the change needs to be the same as the one of a full run.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/watch_turnaround.py
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from nixostools import generate_server_app_configs, ocb_nixos_lib, yaml_lib
+from nixostools.generate_server_app_configs import WatchState
+from nixostools.ocb_nixos_lib import ParseCache
+
+
+def write_configs_file(path: str, index: int, n_servers: int, version: int) -> None:
+    configs = {
+        f"config-{index:04d}-{j}": {
+            "path": f"app-{index:04d}/config-{j}.env",
+            "content": "".join(
+                f"SETTING_{k}=value {k} of config {j} version {version}\n"
+                for k in range(10)
+            ),
+            "servers": [
+                f"server-{(index * 7 + j * 13 + k) % n_servers:04d}" for k in range(5)
+            ],
+        }
+        for j in range(3)
+    }
+    with open(path, "w") as f:
+        yaml_lib.safe_dump({"configs": configs}, f, literal=True)
+
+
+def full_run(configs_directory: str) -> str:
+    configs = generate_server_app_configs.get_configs(
+        generate_server_app_configs.read_configs_files(
+            generate_server_app_configs.find_configs_files(configs_directory)
+        )
+    )
+    return yaml_lib.safe_dump(
+        {data.server_name: data.configs for data in configs}, literal=True
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--servers", type=int, default=300)
+    parser.add_argument("--changes", type=int, default=20)
+    parser.add_argument("--budget_ms", type=float, default=100)
+    parser.add_argument(
+        "--initial_budget_s",
+        type=float,
+        default=5,
+        help="maximum time of the initial run, with a cold or a warm parse cache",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        configs_directory = os.path.join(directory, "configs")
+        output_path = os.path.join(directory, "generated-app-configs.yml")
+        cache_path = os.path.join(directory, "parse.sqlite")
+        os.makedirs(configs_directory)
+        paths = [
+            os.path.join(configs_directory, f"app-{i:04d}-configs.yml")
+            for i in range(args.files)
+        ]
+        for i, path in enumerate(paths):
+            write_configs_file(path, i, args.servers, 0)
+
+        # Like --watch, every regeneration goes through the parse cache.
+        def regenerate(state: WatchState, parse_cache: ParseCache) -> float:
+            start = time.perf_counter()
+            generate_server_app_configs.regenerate_configs(
+                state,
+                generate_server_app_configs.scan_configs_files(configs_directory),
+                output_path,
+                parse_cache,
+                lambda _: True,
+                lambda server: {"hostname": server},
+            )
+            return time.perf_counter() - start
+
+        failures = []
+        # The first start of --watch, then a restart once the cache is filled
+        for cache in ["cold", "warm"]:
+            with ocb_nixos_lib.open_parse_cache(cache_path) as parse_cache:
+                seconds = regenerate(WatchState(), parse_cache)
+            print(f"Initial run with a {cache} parse cache: {seconds:.3f} s")
+            if seconds > args.initial_budget_s:
+                failures.append(f"the initial run with a {cache} cache")
+
+        times = []
+        with ocb_nixos_lib.open_parse_cache(cache_path) as parse_cache:
+            state = WatchState()
+            regenerate(state, parse_cache)
+            for change in range(1, args.changes + 1):
+                index = change * 37 % args.files
+                write_configs_file(paths[index], index, args.servers, change)
+                times.append(regenerate(state, parse_cache) * 1000)
+
+        with open(output_path) as f:
+            assert f.read() == full_run(configs_directory), "the output differs"
+
+    median = statistics.median(times)
+    print(
+        f"Turnaround for one changed file out of {args.files}: "
+        + f"median {median:.1f} ms, max {max(times):.1f} ms"
+    )
+    if median > args.budget_ms:
+        failures.append("the turnaround")
+    if failures:
+        raise SystemExit(f"Over the budget: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Benchmark for yaml_lib, comparing the libyaml and the pure-Python backends
+# on a generated secrets file and a generated app configs file for a fleet of hosts.
+# Both backends need to give byte-identical output.
+#
+# Run from scripts/python_nixostools:
+#   PYTHONPATH=. python3 benchmarks/yaml_backends.py
+import argparse
+import base64
+import random
+import time
+
+from nixostools import secret_lib, yaml_lib
+
+
+def make_generated_secrets(n_servers: int, secrets_size: int) -> dict:
+    rng = random.Random(n_servers)
+    return {
+        f"server-{i:04d}": {
+            "encrypted_key": secret_lib.chunk(base64.b64encode(rng.randbytes(80))),
+            "encrypted_secrets": secret_lib.chunk(
+                base64.b64encode(rng.randbytes(secrets_size))
+            ),
+        }
+        for i in range(n_servers)
+    }
+
+
+def make_generated_app_configs(n_servers: int, configs_per_server: int) -> dict:
+    return {
+        f"server-{i:04d}": {
+            f"config-{j:03d}": {
+                "path": f"app-{j:03d}/config.env",
+                "content": "".join(
+                    f"SETTING_{k}=value for server-{i:04d} and config {j}\n"
+                    for k in range(10)
+                ),
+            }
+            for j in range(configs_per_server)
+        }
+        for i in range(n_servers)
+    }
+
+
+def timed(fn) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start, result)
+
+
+def compare(name: str, data: dict, **kwargs) -> None:
+    (python_dump, python_text) = timed(
+        lambda: yaml_lib.safe_dump(data, libyaml=False, **kwargs)
+    )
+    (libyaml_dump, libyaml_text) = timed(
+        lambda: yaml_lib.safe_dump(data, libyaml=True, **kwargs)
+    )
+    assert python_text == libyaml_text, f"{name}: the dumped YAML differs"
+    (python_load, python_data) = timed(
+        lambda: yaml_lib.safe_load(python_text, libyaml=False)
+    )
+    (libyaml_load, libyaml_data) = timed(
+        lambda: yaml_lib.safe_load(python_text, libyaml=True)
+    )
+    assert python_data == libyaml_data, f"{name}: the loaded data differs"
+    size = len(str(python_text)) / 1e6
+    for operation, python_time, libyaml_time in [
+        ("dump", python_dump, libyaml_dump),
+        ("load", python_load, libyaml_load),
+    ]:
+        print(
+            f"{name:>12} {size:>7.1f} {operation:>5} {python_time:>10.3f} "
+            + f"{libyaml_time:>10.3f} {python_time / libyaml_time:>7.1f}x"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", type=int, default=1000)
+    parser.add_argument("--secrets_size", type=int, default=4096)
+    parser.add_argument("--configs_per_server", type=int, default=10)
+    args = parser.parse_args()
+
+    if not yaml_lib.LIBYAML:
+        raise SystemExit("PyYAML was built without libyaml, nothing to compare.")
+
+    print(
+        f"{'file':>12} {'MB':>7} {'op':>5} {'python (s)':>10} "
+        + f"{'libyaml (s)':>10} {'speedup':>8}"
+    )
+    compare(
+        "secrets",
+        make_generated_secrets(args.servers, args.secrets_size),
+        default_style="|",
+    )
+    compare(
+        "app configs",
+        make_generated_app_configs(args.servers, args.configs_per_server),
+        literal=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
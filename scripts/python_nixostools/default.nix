@@ -13,13 +13,15 @@ let
     fileset = lib.fileset.unions [
       ./pyproject.toml
       ./nixostools
+      ./benchmarks/vault_compat.py
+      ./benchmarks/vault_fixtures
     ];
   };
 
   package =
     {
       buildPythonApplication,
-      ansible-core,
+      cryptography,
       flit-core,
       mypy,
       pylint,
@@ -49,7 +51,7 @@ let
       ];
       propagatedBuildInputs = [
         flit-core
-        ansible-core
+        cryptography
         pynacl
         pyyaml
         requests
@@ -59,6 +61,8 @@ let
         mypy ${src}/nixostools
         ruff check --no-cache ${src}/nixostools
         PYLINTHOME="$TMPDIR" pylint ${src}/nixostools
+        # Check the native Ansible Vault codec against files made by ansible-vault
+        PYTHONPATH="${src}:$PYTHONPATH" python3 ${src}/benchmarks/vault_compat.py
       '';
 
       meta = {
@@ -1,12 +1,11 @@
 import getopt
-import json
 import sys
 from pathlib import Path
 
+from nixostools import ocb_nixos_lib
 
-def main() -> None:
-    f = open("../../org-config/json/users.json")
 
+def main() -> None:
     # Create a list of arguments without the name of the script
     argv = sys.argv[1:]
     # Set the short options we are expecting (i.e -h or -v)
@@ -41,7 +40,15 @@ def main() -> None:
         print("Output directory does not exist or not a directory")
         exit()
 
-    data = json.load(f)
+    with ocb_nixos_lib.open_snapshot(
+        {ocb_nixos_lib.USERS_SOURCE: "../../org-config/json/users.json"}
+    ) as snapshot:
+        data = {
+            "users": {
+                "per-host": snapshot.records("users"),
+                "roles": snapshot.records("roles"),
+            }
+        }
 
     users = set()
 
@@ -1,5 +1,9 @@
 import argparse
+import csv
+import json
 import secrets
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass
 
 from nixostools import ansible_vault_lib
 from nixostools.secret_lib import (
@@ -12,7 +16,23 @@ from nixostools.secret_lib import (
 
 def args_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
-    parser.add_argument("--hostname", dest="hostname", required=True, type=str)
+    hosts = parser.add_mutually_exclusive_group(required=True)
+    hosts.add_argument("--hostname", dest="hostname", type=str)
+    hosts.add_argument(
+        "--hostnames",
+        dest="hostnames",
+        nargs="+",
+        type=str,
+        help="add new keys for all these hosts, reading and writing the secrets "
+        + "files only once",
+    )
+    hosts.add_argument(
+        "--manifest",
+        dest="manifest",
+        type=str,
+        help="CSV or JSON file listing the hosts to add keys for, "
+        + "with hostname and optionally key and recovery_key fields",
+    )
     parser.add_argument("--dry-run", dest="dry_run", action="store_true")
     parser.add_argument(
         "--secrets_file",
@@ -33,14 +53,14 @@ def args_parser() -> argparse.ArgumentParser:
         dest="key",
         required=False,
         type=str,
-        help="the new key to add",
+        help="the new key to add, only with --hostname",
     )
     parser.add_argument(
         "--recovery_key",
         dest="recovery_key",
         required=False,
         type=str,
-        help="the new recovery key to add",
+        help="the new recovery key to add, only with --hostname",
     )
     parser.add_argument(
         "--remove_entries_from",
@@ -52,79 +72,148 @@ def args_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def main() -> None:
-    args = args_parser().parse_args()
+# The keys to add for a single host
+@dataclass(frozen=True)
+class HostKeys:
+    hostname: str
+    key: str
+    recovery_key: str
 
-    print(f"Adding the encryption keys for {args.hostname}...")
 
-    if not args.dry_run:
-        ansible_vault_passwd = ansible_vault_lib.get_ansible_passwd(
-            args.ansible_vault_passwd
-        )
+def main_key_name(hostname: str) -> str:
+    return f"{hostname}-encryption-key"
 
-    if not args.dry_run:
-        try:
-            data = ansible_vault_lib.read_vault_file(
-                ansible_vault_passwd, args.secrets_file
-            )
-        except FileNotFoundError:
-            data = {SECRETS_KEY: {}}
-
-        if args.remove_entries_from:
-            try:
-                old_data = ansible_vault_lib.read_vault_file(
-                    ansible_vault_passwd, args.remove_entries_from
-                )
-            except FileNotFoundError:
-                old_data = None
-        else:
-            old_data = None
-    else:
-        data = {SECRETS_KEY: {}}
-        old_data = None
 
-    if not args.key:
-        key = secrets.token_hex(64)
-    else:
-        key = args.key
+def recovery_key_name(hostname: str) -> str:
+    return f"{hostname}-recovery-encryption-key"
 
-    if not args.recovery_key:
-        recovery_key = secrets.token_hex(64)
-    else:
-        recovery_key = args.recovery_key
 
-    main_key = f"{args.hostname}-encryption-key"
-    recovery_key = f"{args.hostname}-recovery-encryption-key"
+# New keys get generated for the hosts for which no key was given.
+def host_keys(
+    hostname: str, key: str | None = None, recovery_key: str | None = None
+) -> HostKeys:
+    return HostKeys(
+        hostname=hostname,
+        key=key or secrets.token_hex(64),
+        recovery_key=recovery_key or secrets.token_hex(64),
+    )
+
 
-    data[SECRETS_KEY][main_key] = {
+# Read the hosts from a CSV file with a header line, or from a JSON file
+# containing a list of host names or of objects with the same fields.
+def read_manifest(manifest: str) -> list[Mapping]:
+    with open(manifest, newline="") as f:
+        if manifest.endswith(".csv"):
+            return list(csv.DictReader(f))
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise Exception(f"The manifest {manifest} should contain a list of hosts.")
+    return [
+        {"hostname": entry} if isinstance(entry, str) else entry for entry in entries
+    ]
+
+
+def collect_hosts(args: argparse.Namespace) -> list[HostKeys]:
+    if args.hostname:
+        hosts = [host_keys(args.hostname, args.key, args.recovery_key)]
+    elif args.key or args.recovery_key:
+        raise Exception("--key and --recovery_key can only be used with --hostname.")
+    elif args.hostnames:
+        hosts = [host_keys(hostname) for hostname in args.hostnames]
+    else:
+        hosts = [
+            host_keys(entry["hostname"], entry.get("key"), entry.get("recovery_key"))
+            for entry in read_manifest(args.manifest)
+        ]
+    hostnames = [host.hostname for host in hosts]
+    duplicates = sorted({h for h in hostnames if hostnames.count(h) > 1})
+    if duplicates:
+        raise Exception(f"Duplicate hosts: {', '.join(duplicates)}")
+    return hosts
+
+
+def add_host_keys(data: Mapping, host: HostKeys) -> None:
+    data[SECRETS_KEY][main_key_name(host.hostname)] = {
         PATH_KEY: "keyfile",
-        CONTENT_KEY: key,
-        SERVERS_KEY: [args.hostname],
+        CONTENT_KEY: host.key,
+        SERVERS_KEY: [host.hostname],
     }
 
-    data[SECRETS_KEY][recovery_key] = {
+    data[SECRETS_KEY][recovery_key_name(host.hostname)] = {
         PATH_KEY: "recovery-keyfile",
-        CONTENT_KEY: recovery_key,
+        CONTENT_KEY: host.recovery_key,
         # This key should not be accessible by any server!!
         SERVERS_KEY: [],
     }
 
-    if not args.dry_run:
+
+# Remove the old keys of the host, returns whether there were any.
+def remove_host_keys(old_data: Mapping, host: HostKeys) -> bool:
+    old_secrets = old_data.get(SECRETS_KEY, {})
+    main_key_removed = old_secrets.pop(main_key_name(host.hostname), None)
+    recovery_key_removed = old_secrets.pop(recovery_key_name(host.hostname), None)
+    return bool(main_key_removed or recovery_key_removed)
+
+
+def read_vault_file_or_none(passwd: str, vault_file: str) -> Mapping | None:
+    try:
+        return ansible_vault_lib.read_vault_file(passwd, vault_file)
+    except FileNotFoundError:
+        return None
+
+
+def format_hostnames(hosts: Sequence[HostKeys]) -> str:
+    return ", ".join(host.hostname for host in hosts)
+
+
+def main() -> None:
+    args = args_parser().parse_args()
+    hosts = collect_hosts(args)
+
+    print(f"Adding the encryption keys for {format_hostnames(hosts)}...")
+
+    if args.dry_run:
+        data: Mapping = {SECRETS_KEY: {}}
+        for host in hosts:
+            add_host_keys(data, host)
+        print(data)
+        return
+
+    ansible_vault_passwd = ansible_vault_lib.get_ansible_passwd(
+        args.ansible_vault_passwd
+    )
+    vault_files = [args.secrets_file]
+    if args.remove_entries_from:
+        vault_files.append(args.remove_entries_from)
+
+    # Every vault file gets decrypted and written at most once, for all hosts
+    with ansible_vault_lib.locked_vault_files(vault_files):
+        data = read_vault_file_or_none(ansible_vault_passwd, args.secrets_file) or {
+            SECRETS_KEY: {}
+        }
+        old_data = (
+            read_vault_file_or_none(ansible_vault_passwd, args.remove_entries_from)
+            if args.remove_entries_from
+            else None
+        )
+
+        for host in hosts:
+            add_host_keys(data, host)
         ansible_vault_lib.write_vault_file(
             ansible_vault_passwd, args.secrets_file, data
         )
-        print(f"Encryption keys for {args.hostname} successfully added.")
+        print(f"Encryption keys for {format_hostnames(hosts)} successfully added.")
 
         if old_data:
-            main_key_removed = old_data.get(SECRETS_KEY, {}).pop(main_key, None)
-            recovery_key_removed = old_data.get(SECRETS_KEY, {}).pop(recovery_key, None)
-            if main_key_removed or recovery_key_removed:
+            removed = [host for host in hosts if remove_host_keys(old_data, host)]
+            if removed:
                 ansible_vault_lib.write_vault_file(
                     ansible_vault_passwd, args.remove_entries_from, old_data
                 )
-                print(f"Old encryption keys for {args.hostname} successfully removed.")
-    else:
-        print(data)
+                print(
+                    f"Old encryption keys for {format_hostnames(removed)} "
+                    + "successfully removed."
+                )
 
 
 if __name__ == "__main__":
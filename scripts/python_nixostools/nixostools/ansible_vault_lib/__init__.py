@@ -1,18 +1,46 @@
+import fcntl
+import hashlib
+import hmac
+import json
 import os
-from collections.abc import Mapping
+import tempfile
+from binascii import Error as BinasciiError
+from binascii import hexlify, unhexlify
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from contextlib import ExitStack, contextmanager
+from functools import partial
 from getpass import getpass
+from typing import Any
 
-import yaml
-from ansible.constants import (  # type: ignore  # pylint: disable=E0611
-    DEFAULT_VAULT_ID_MATCH,
-)
-from ansible.parsing.vault import VaultLib, VaultSecret  # type: ignore
+from nixostools import ocb_nixos_lib, yaml_lib
+from nixostools.secret_lib import SECRETS_KEY, SERVERS_KEY
 
-UTF8 = "utf-8"
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
 
+UTF8 = "utf-8"
 
-# See the following link for the source code and the API of the vault library:
+# Format of the Ansible Vault 1.1 AES256 files, as written by ansible-vault.
+# See format_vaulttext_envelope and VaultAES256 in the source code of Ansible:
 # https://github.com/ansible/ansible/blob/devel/lib/ansible/parsing/vault/__init__.py
+VAULT_HEADER: bytes = b"$ANSIBLE_VAULT"
+VAULT_VERSION: bytes = b"1.1"
+VAULT_CIPHER: bytes = b"AES256"
+VAULT_LINE_WIDTH: int = 80
+VAULT_SALT_LENGTH: int = 32
+VAULT_KEY_LENGTH: int = 32
+VAULT_IV_LENGTH: int = 16
+VAULT_KDF_ITERATIONS: int = 10000
+AES_BLOCK_SIZE: int = 16
+
+# Name and version of the routing index kept next to the vault files,
+# see update_routing_index
+ROUTING_INDEX_FILE: str = ".vault-routing.json"
+ROUTING_INDEX_VERSION: int = 1
 
 
 def print_vault_banner() -> None:
@@ -28,21 +56,209 @@ def get_ansible_passwd(args_passwd: str) -> str:
     return args_passwd
 
 
-def get_vaultlib(passwd: str) -> VaultLib:
+# Derive the AES key, the HMAC key and the initial counter block from the password.
+def derive_vault_keys(passwd: str, salt: bytes) -> tuple[bytes, bytes, bytes]:
+    derived_key = hashlib.pbkdf2_hmac(
+        "sha256",
+        passwd.encode(UTF8),
+        salt,
+        VAULT_KDF_ITERATIONS,
+        dklen=2 * VAULT_KEY_LENGTH + VAULT_IV_LENGTH,
+    )
+    return (
+        derived_key[:VAULT_KEY_LENGTH],
+        derived_key[VAULT_KEY_LENGTH : 2 * VAULT_KEY_LENGTH],
+        derived_key[2 * VAULT_KEY_LENGTH :],
+    )
+
+
+def aes_ctr(key: bytes, iv: bytes, data: bytes) -> bytes:
+    cryptor = Cipher(algorithms.AES(key), modes.CTR(iv)).encryptor()
+    return cryptor.update(data) + cryptor.finalize()
+
+
+def vault_encrypt(passwd: str, plaintext: bytes) -> bytes:
+    if not HAS_CRYPTOGRAPHY:
+        return ansible_vault(passwd).encrypt(plaintext)
+    salt = os.urandom(VAULT_SALT_LENGTH)
+    (aes_key, hmac_key, iv) = derive_vault_keys(passwd, salt)
+    # PKCS#7 padding, even though CTR mode does not need it
+    padding_length = AES_BLOCK_SIZE - len(plaintext) % AES_BLOCK_SIZE
+    ciphertext = aes_ctr(
+        aes_key, iv, plaintext + bytes([padding_length]) * padding_length
+    )
+    digest = hmac.new(hmac_key, ciphertext, hashlib.sha256).hexdigest().encode()
+    vaulttext = hexlify(b"\n".join([hexlify(salt), digest, hexlify(ciphertext)]))
+    header = b";".join([VAULT_HEADER, VAULT_VERSION, VAULT_CIPHER])
+    lines = [
+        vaulttext[i : i + VAULT_LINE_WIDTH]
+        for i in range(0, len(vaulttext), VAULT_LINE_WIDTH)
+    ]
+    return b"\n".join([header, *lines, b""])
+
+
+# Decrypt the content of a vault file, in the 1.1 format or in the 1.2 format,
+# which only adds a vault ID to the header.
+def vault_decrypt(passwd: str, vault_file: str, content: bytes) -> bytes:
+    if not HAS_CRYPTOGRAPHY:
+        return ansible_vault(passwd).decrypt(content)
+    (header, *lines) = content.strip().splitlines()
+    header_parts = [part.strip() for part in header.split(b";")]
+    if (
+        len(header_parts) < 3
+        or header_parts[0] != VAULT_HEADER
+        or header_parts[1] not in [b"1.1", b"1.2"]
+        or header_parts[2] != VAULT_CIPHER
+    ):
+        raise Exception(f"Ansible Vault file ({vault_file}): unsupported format.")
+    try:
+        (salt, digest, ciphertext) = unhexlify(b"".join(lines)).split(b"\n", 2)
+        salt = unhexlify(salt)
+        ciphertext = unhexlify(ciphertext)
+        expected_digest = unhexlify(digest)
+    except (BinasciiError, ValueError) as e:
+        raise Exception(f"Ansible Vault file ({vault_file}): invalid format.") from e
+    (aes_key, hmac_key, iv) = derive_vault_keys(passwd, salt)
+    if not hmac.compare_digest(
+        hmac.new(hmac_key, ciphertext, hashlib.sha256).digest(), expected_digest
+    ):
+        raise Exception(
+            f"Ansible Vault file ({vault_file}): decryption failed, wrong password?"
+        )
+    padded = aes_ctr(aes_key, iv, ciphertext)
+    padding_length = padded[-1] if padded else 0
+    if not (
+        1 <= padding_length <= AES_BLOCK_SIZE
+        and padded.endswith(bytes([padding_length]) * padding_length)
+    ):
+        raise Exception(f"Ansible Vault file ({vault_file}): invalid padding.")
+    return padded[:-padding_length]
+
+
+# Fall back to Ansible's own implementation, when the cryptography package
+# is not available. We only import Ansible here, since importing it is slow.
+def ansible_vault(passwd: str) -> Any:
+    from ansible.constants import (  # type: ignore  # pylint: disable=E0611,E0401,C0415
+        DEFAULT_VAULT_ID_MATCH,
+    )
+    from ansible.parsing.vault import (  # type: ignore  # pylint: disable=E0401,C0415
+        VaultLib,
+        VaultSecret,
+    )
+
     return VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(passwd.encode(UTF8)))])
 
 
 def read_vault_file(passwd: str, vault_file: str) -> Mapping:
-    vault = get_vaultlib(passwd)
     if os.path.isfile(vault_file):
-        with open(vault_file) as f:
-            return yaml.safe_load(vault.decrypt(f.read()))
+        with open(vault_file, "rb") as f:
+            return yaml_lib.safe_load(vault_decrypt(passwd, vault_file, f.read()))
     else:
         raise FileNotFoundError(f"Ansible Vault file ({vault_file}): no such file!")
 
 
+# Decrypt several vault files, using up to jobs worker processes.
+# Every file pays for its own PBKDF2 key derivation, which makes this CPU-bound,
+# so we use processes rather than threads.
+# The results are returned in the same order as the given files.
+def read_vault_files(
+    passwd: str, vault_files: Sequence[str], jobs: int | None = None
+) -> list[Mapping]:
+    return ocb_nixos_lib.parallel_map(
+        partial(read_vault_file, passwd), vault_files, jobs
+    )
+
+
 def write_vault_file(passwd: str, vault_file: str, content: Mapping) -> None:
-    vault = get_vaultlib(passwd)
-    encrypted_content = vault.encrypt(yaml.safe_dump(content))
+    encrypted_content = vault_encrypt(passwd, yaml_lib.safe_dump(content).encode(UTF8))
     with open(vault_file, "wb+") as f:
         f.write(encrypted_content)
+    update_routing_index({vault_file: content})
+
+
+def routing_index_path(directory: str) -> str:
+    return os.path.join(directory, ROUTING_INDEX_FILE)
+
+
+def vault_file_digest(vault_file: str) -> str:
+    with open(vault_file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# The servers targeted by the secrets in the content of a vault file
+def vault_file_servers(content: Mapping) -> list[str]:
+    return sorted(
+        {
+            server
+            for secret in (content.get(SECRETS_KEY) or {}).values()
+            if isinstance(secret, Mapping) and isinstance(secret.get(SERVERS_KEY), list)
+            for server in secret[SERVERS_KEY]
+        }
+    )
+
+
+def read_routing_index(directory: str) -> Mapping[str, Mapping]:
+    try:
+        with open(routing_index_path(directory)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if index.get("version") != ROUTING_INDEX_VERSION:
+        return {}
+    return index.get("files", {})
+
+
+# Record, in a plaintext index in the folder of every given vault file,
+# the servers targeted by the file's secrets, together with the digest of the
+# encrypted file. This allows finding the vault files relevant to some servers
+# without decrypting all of them. The index only reveals which servers
+# every vault file has secrets for, which the tunnels config already tells.
+def update_routing_index(contents: Mapping[str, Mapping]) -> None:
+    per_directory: dict[str, dict[str, Mapping]] = {}
+    for vault_file, content in contents.items():
+        directory = os.path.dirname(os.path.abspath(vault_file))
+        per_directory.setdefault(directory, {})[os.path.basename(vault_file)] = {
+            "sha256": vault_file_digest(vault_file),
+            "servers": vault_file_servers(content),
+        }
+    for directory, entries in per_directory.items():
+        index = {
+            "version": ROUTING_INDEX_VERSION,
+            "files": {**read_routing_index(directory), **entries},
+        }
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+            f.write("\n")
+        os.replace(f.name, routing_index_path(directory))
+
+
+# The servers targeted by every given vault file according to the routing index,
+# or None for the files that changed since they were indexed, or were never indexed.
+def routed_servers(vault_files: Iterable[str]) -> Mapping[str, list[str] | None]:
+    indexes: dict[str, Mapping[str, Mapping]] = {}
+
+    def lookup(vault_file: str) -> list[str] | None:
+        directory = os.path.dirname(os.path.abspath(vault_file))
+        if directory not in indexes:
+            indexes[directory] = read_routing_index(directory)
+        entry = indexes[directory].get(os.path.basename(vault_file))
+        if not entry or entry.get("sha256") != vault_file_digest(vault_file):
+            return None
+        return entry.get("servers", [])
+
+    return {vault_file: lookup(vault_file) for vault_file in vault_files}
+
+
+# Hold an exclusive lock on the folders of the given vault files, so that
+# concurrent runs cannot overwrite each other's changes between reading
+# and writing the files. The folders are locked in sorted order,
+# which avoids deadlocks between runs locking several of them.
+@contextmanager
+def locked_vault_files(vault_files: Iterable[str]) -> Iterator[None]:
+    directories = {os.path.dirname(os.path.abspath(f)) for f in vault_files}
+    with ExitStack() as stack:
+        for directory in sorted(directories):
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            stack.callback(os.close, fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
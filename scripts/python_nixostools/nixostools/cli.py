@@ -0,0 +1,74 @@
+import importlib
+import os
+import sys
+from collections.abc import Callable
+
+# The subcommands of the nixostools command, with the module implementing them.
+# A module only gets imported when its subcommand runs, so that running one
+# command does not pay for the dependencies of all the others.
+SUBCOMMANDS: dict[str, str] = {
+    "add_encryption_key": "nixostools.add_encryption_key",
+    "copy_down_dhis": "nixostools.copy_down_dhis2",
+    "decrypt_server_secrets": "nixostools.decrypt_server_secrets",
+    "encrypt_server_secrets": "nixostools.encrypt_server_secrets",
+    "extract_server_app_configs": "nixostools.extract_server_app_configs",
+    "generate_server_app_configs": "nixostools.generate_server_app_configs",
+    "update_nixos_keys": "nixostools.update_nixos_keys",
+}
+
+
+def usage() -> str:
+    return "\n".join(
+        [
+            "usage: nixostools <command> [<args>]",
+            "",
+            "commands:",
+            *(f"  {name}" for name in SUBCOMMANDS),
+            "",
+            "Run nixostools <command> --help for the arguments of a command.",
+        ]
+    )
+
+
+# Import the module of the given subcommand and run its main function
+# with the given program name and arguments.
+def run(name: str, prog: str, args: list[str]) -> None:
+    module = importlib.import_module(SUBCOMMANDS[name])
+    sys.argv = [prog, *args]
+    module.main()
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    if not args:
+        print(usage(), file=sys.stderr)
+        sys.exit(2)
+    if args[0] in ("-h", "--help"):
+        print(usage())
+        return
+    name = args[0]
+    if name not in SUBCOMMANDS:
+        print(f"nixostools: unknown command {name}\n\n{usage()}", file=sys.stderr)
+        sys.exit(2)
+    run(name, f"{os.path.basename(sys.argv[0])} {name}", args[1:])
+
+
+# The entry points of the separate scripts, kept for the existing callers,
+# which go through the same lazy import as the nixostools command.
+def shim(name: str) -> Callable[[], None]:
+    def main() -> None:
+        run(name, sys.argv[0], sys.argv[1:])
+
+    return main
+
+
+add_encryption_key = shim("add_encryption_key")
+copy_down_dhis = shim("copy_down_dhis")
+decrypt_server_secrets = shim("decrypt_server_secrets")
+encrypt_server_secrets = shim("encrypt_server_secrets")
+extract_server_app_configs = shim("extract_server_app_configs")
+generate_server_app_configs = shim("generate_server_app_configs")
+update_nixos_keys = shim("update_nixos_keys")
+
+if __name__ == "__main__":
+    main()
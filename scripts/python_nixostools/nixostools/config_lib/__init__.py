@@ -1,3 +1,8 @@
+import functools
+import hashlib
+import string
+from collections.abc import Mapping
+
 CONFIGS_KEY = "configs"
 SERVERS_KEY = "servers"
 PATH_KEY = "path"
@@ -5,3 +10,85 @@ CONTENT_KEY = "content"
 TUNNELS_KEY = "tunnels"
 PER_HOST_KEY = "per-host"
 PUBLIC_KEY_KEY = "public_key"
+# Templated configs have a template instead of a content, which gets rendered
+# for every server, see render_template, with the variables of that server.
+TEMPLATE_KEY = "template"
+# The variables of every server, in addition to the ones from the tunnel config
+VARS_KEY = "vars"
+
+# Layout of the deduplicated generated app configs file, see dedup_configs in
+# generate_server_app_configs. Every distinct content is stored only once,
+# in a table of blobs keyed by the hash of the content, and the configs
+# of every server refer to their content by that hash.
+DEDUP_FORMAT_KEY = "_format"
+DEDUP_FORMAT = "dedup-1"
+DEDUP_BLOBS_KEY = "blobs"
+DEDUP_SERVERS_KEY = "servers"
+BLOB_KEY = "blob"
+
+
+def is_dedup_configs(content: Mapping) -> bool:
+    return content.get(DEDUP_FORMAT_KEY) == DEDUP_FORMAT
+
+
+# The hash by which the deduplicated layout refers to a content
+def content_hash(content: str) -> str:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Extract the configs of a single server from a deduplicated configs file,
+# replacing the references to the blobs by their content.
+def dedup_server_configs(content: Mapping, server_name: str) -> Mapping | None:
+    configs = content.get(DEDUP_SERVERS_KEY, {}).get(server_name)
+    if configs is None:
+        return None
+    blobs = content.get(DEDUP_BLOBS_KEY, {})
+
+    def resolve(config_name: str, config: Mapping) -> Mapping:
+        blob = config.get(BLOB_KEY)
+        if blob not in blobs:
+            raise Exception(f"The config {config_name} refers to a missing blob.")
+        return {
+            **{k: v for k, v in config.items() if k != BLOB_KEY},
+            CONTENT_KEY: blobs[blob],
+        }
+
+    return {
+        config_name: resolve(config_name, config)
+        for config_name, config in configs.items()
+    }
+
+
+# Split a template, in the syntax of string.Template ($name or ${name},
+# and $$ for a literal $), into pieces of literal text, each followed by the name
+# of a variable, or by None for the last piece.
+# Templates are compiled once, however many servers they get rendered for.
+@functools.cache
+def compile_template(template: str) -> tuple[tuple[str, str | None], ...]:
+    pieces = []
+    literal = []
+    position = 0
+    for match in string.Template.pattern.finditer(template):
+        literal.append(template[position : match.start()])
+        position = match.end()
+        name = match["named"] or match["braced"]
+        if match["escaped"] is not None:
+            literal.append("$")
+        elif name:
+            pieces.append(("".join(literal), name))
+            literal = []
+        else:
+            raise ValueError(f"Invalid placeholder in template at {match.start()}")
+    literal.append(template[position:])
+    pieces.append(("".join(literal), None))
+    return tuple(pieces)
+
+
+# Raises a KeyError for variables that are not defined.
+def render_template(template: str, variables: Mapping) -> str:
+    rendered = []
+    for literal, name in compile_template(template):
+        rendered.append(literal)
+        if name is not None:
+            rendered.append(str(variables[name]))
+    return "".join(rendered)
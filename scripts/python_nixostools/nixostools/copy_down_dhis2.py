@@ -8,7 +8,6 @@ import tempfile
 from pathlib import Path
 
 # ---------- Logging ----------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger("nixostools/copy_down_dhis")
 
 
@@ -352,6 +351,9 @@ def start_docker_container(container_name):
 
 # ---------- Main ----------
 def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
     check_requirements()
 
     # SSH & relay
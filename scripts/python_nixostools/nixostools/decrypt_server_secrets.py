@@ -1,9 +1,12 @@
 import argparse
 import os
+from base64 import b64decode
+from collections.abc import Callable, Mapping
+from typing import BinaryIO
 
-import yaml
+from nacl.public import PrivateKey
 
-from nixostools import secret_lib, util_lib
+from nixostools import secret_lib, util_lib, yaml_lib
 
 
 def args_parser() -> argparse.ArgumentParser:
@@ -36,12 +39,67 @@ def args_parser() -> argparse.ArgumentParser:
         dest="private_key_file",
         help="private key file of the server",
     )
+    parser.add_argument(
+        "--blobs_directory",
+        type=str,
+        required=False,
+        dest="blobs_directory",
+        help="folder containing the stream-encrypted content of binary secrets, "
+        + "defaults to the blobs folder next to the generated secrets file",
+    )
     parser.add_argument(
         "--extract_all",
         action="store_true",
         dest="extract_all",
         help="extract-all secrets including these default_extract: false",
     )
+    parser.add_argument(
+        "--secret",
+        type=str,
+        required=False,
+        dest="secret",
+        help="only extract the secret with this name, even if it has "
+        + "default_extract: false, without decrypting the other secrets "
+        + "if the secrets use the table of contents layout",
+    )
+    parser.add_argument(
+        "--skip_unchanged",
+        action="store_true",
+        dest="skip_unchanged",
+        help="do nothing if the encrypted secrets of this server and the files "
+        + "in the output folder did not change since the previous run, "
+        + "otherwise empty the output folder before writing the secrets",
+    )
+    parser.add_argument(
+        "--state_file",
+        type=str,
+        required=False,
+        dest="state_file",
+        help="file in which --skip_unchanged records the state of the previous run, "
+        + "defaults to the output path with a .state.json suffix",
+    )
+    parser.add_argument(
+        "--atomic",
+        action="store_true",
+        dest="atomic",
+        help="write the files to a staging folder and then atomically "
+        + "swap it with the output folder",
+    )
+    parser.add_argument(
+        "--owner",
+        type=str,
+        required=False,
+        dest="owner",
+        help="owner (user:group) of the created files and folders",
+    )
+    parser.add_argument(
+        "--acl",
+        type=str,
+        required=False,
+        dest="acl",
+        help="ACL, in the format used by setfacl --set, "
+        + "to set on the created files and folders",
+    )
     return parser
 
 
@@ -57,29 +115,186 @@ def validate_dir(dir):
         raise Exception(f"Cannot open the file ({dir}), " + not_a_dir_msg)
 
 
+# Read the encrypted secrets of the given server, from either an indexed
+# or a YAML generated secrets file.
+def read_server_secrets(secrets_path: str, server_name: str) -> Mapping | None:
+    if secret_lib.is_indexed_secrets_file(secrets_path):
+        return secret_lib.read_indexed_secrets(secrets_path, server_name)
+    with open(secrets_path) as f:
+        all_secrets = yaml_lib.safe_load(f)
+    if secret_lib.is_envelope_secrets(all_secrets):
+        return secret_lib.envelope_server_record(all_secrets, server_name)
+    return all_secrets.get(server_name)
+
+
+def decrypt_yaml(key: bytes, encrypted: str) -> Mapping:
+    return yaml_lib.safe_load(
+        secret_lib.decode_payload(secret_lib.decrypt_symmetric_bytes(key, encrypted))
+    )
+
+
+def read_private_key(private_key_file: str) -> PrivateKey:
+    validate_file(private_key_file)
+    with open(private_key_file) as f:
+        server_privk = f.read()
+    return secret_lib.extract_curve_private_key(server_privk)
+
+
+# Decrypt the secrets for which select, called with the name and the
+# metadata of the secret, returns True.
+# Depending on the format, we can make this decision before decrypting a secret
+# or only afterwards.
+def decrypt_secrets(
+    secrets_data: Mapping,
+    private_key_file: str,
+    select: Callable[[str, Mapping], bool],
+) -> Mapping:
+    private_key = read_private_key(private_key_file)
+
+    if secret_lib.WRAPPED_KEYS_KEY in secrets_data:
+        decrypted_secrets = decrypt_envelopes(secrets_data, private_key)
+    else:
+        # decrypt the symmetric key using the server private key
+        key = secret_lib.decrypt_asymmetric(private_key, secrets_data["encrypted_key"])
+        if secret_lib.ENCRYPTED_ENTRIES_KEY in secrets_data:
+            return decrypt_entries(secrets_data, key, select)
+        # then use it to decrypt the secrets
+        decrypted_secrets = decrypt_yaml(key, secrets_data["encrypted_secrets"])
+
+    return {
+        name: secret
+        for name, secret in decrypted_secrets.items()
+        if select(name, secret)
+    }
+
+
+# In the table of contents layout, we first decrypt the table of contents,
+# and then only the entries of the secrets that we need.
+def decrypt_entries(
+    secrets_data: Mapping, key: bytes, select: Callable[[str, Mapping], bool]
+) -> Mapping:
+    toc = decrypt_yaml(key, secrets_data["encrypted_secrets"])
+    encrypted_entries = secrets_data[secret_lib.ENCRYPTED_ENTRIES_KEY]
+    decrypted_secrets: dict = {}
+    for name, metadata in toc.items():
+        if select(name, metadata):
+            entry = encrypted_entries[metadata[secret_lib.TOC_ENTRY_KEY]]
+            decrypted_secrets.update(decrypt_yaml(key, entry))
+    return decrypted_secrets
+
+
+# In the envelope format, every secret is encrypted with its own key,
+# which we unwrap with the server's private key.
+def decrypt_envelopes(secrets_data: Mapping, private_key: PrivateKey) -> Mapping:
+    encrypted_secrets = secrets_data[secret_lib.ENCRYPTED_SECRETS_KEY]
+    decrypted_secrets: dict = {}
+    for secret_id, wrapped_key in secrets_data[secret_lib.WRAPPED_KEYS_KEY].items():
+        key = secret_lib.decrypt_asymmetric(private_key, wrapped_key)
+        decrypted_secrets.update(decrypt_yaml(key, encrypted_secrets[secret_id]))
+    return decrypted_secrets
+
+
+# Binary secrets are decrypted straight from their stream-encrypted file
+# into the output file, one chunk at a time, the other secrets are written as text.
+def secret_writer(blobs_directory: str) -> Callable[[BinaryIO, Mapping], None]:
+    def write_secret(f: BinaryIO, secret: Mapping) -> None:
+        stream_file = secret.get(secret_lib.STREAM_FILE_KEY)
+        if stream_file is None:
+            f.write(secret[secret_lib.CONTENT_KEY].encode(secret_lib.UTF8))
+            return
+        if os.path.basename(stream_file) != stream_file:
+            raise Exception(f"Invalid stream file name: {stream_file}")
+        with open(os.path.join(blobs_directory, stream_file), "rb") as blob:
+            secret_lib.decrypt_stream(
+                b64decode(secret[secret_lib.STREAM_KEY_KEY]), blob, f
+            )
+
+    return write_secret
+
+
+# Extract a single secret into the output folder, leaving the other files alone.
+def extract_single_secret(
+    args: argparse.Namespace,
+    secrets_data: Mapping | None,
+    permissions: util_lib.Permissions | None,
+    write_secret: Callable[[BinaryIO, Mapping], None],
+) -> None:
+    def select(name: str, _: Mapping) -> bool:
+        return name == args.secret
+
+    decrypted_secrets = (
+        decrypt_secrets(secrets_data, args.private_key_file, select)
+        if secrets_data
+        else {}
+    )
+    if not decrypted_secrets:
+        raise Exception(f"Secret {args.secret} not found for {args.server_name}.")
+    util_lib.write_files(
+        args.output_path, decrypted_secrets, True, permissions, write_secret
+    )
+
+
 def main():
     args = args_parser().parse_args()
     validate_file(args.secrets_path)
     validate_dir(args.output_path)
+    permissions = util_lib.parse_permissions(args.owner, args.acl)
+    write_secret = secret_writer(
+        args.blobs_directory
+        or os.path.join(os.path.dirname(args.secrets_path), "blobs")
+    )
 
-    with open(args.secrets_path) as f:
-        all_secrets = yaml.safe_load(f)
+    secrets_data = read_server_secrets(args.secrets_path, args.server_name)
 
-    secrets_data = all_secrets.get(args.server_name)
-    if secrets_data:
-        validate_file(args.private_key_file)
-        with open(args.private_key_file) as f:
-            server_privk = f.read()
-        # decrypt the symmetric key using the server private key
-        key = secret_lib.decrypt_asymmetric(
-            secret_lib.extract_curve_private_key(server_privk),
-            secrets_data["encrypted_key"],
+    if args.secret:
+        if args.atomic or args.skip_unchanged:
+            raise Exception(
+                "--secret cannot be combined with --atomic or --skip_unchanged."
+            )
+        extract_single_secret(args, secrets_data, permissions, write_secret)
+        return
+
+    def select(_: str, secret: Mapping) -> bool:
+        return args.extract_all or util_lib.is_default_extract(secret)
+
+    if args.skip_unchanged:
+        state_file = args.state_file or util_lib.default_state_file(args.output_path)
+        state_key = secret_lib.derive_state_key(read_private_key(args.private_key_file))
+        digest = util_lib.input_digest(
+            secrets_data, extract_all=args.extract_all, owner=args.owner, acl=args.acl
         )
-        # then use it to decrypt the secrets
-        decrypted_secrets = yaml.safe_load(
-            secret_lib.decrypt_symmetric(key, secrets_data["encrypted_secrets"])
+        if util_lib.is_unchanged(state_file, digest, args.output_path, state_key):
+            print("The secrets did not change since the previous run, nothing to do.")
+            return
+        util_lib.remove_state(state_file)
+
+    decrypted_secrets = (
+        decrypt_secrets(secrets_data, args.private_key_file, select)
+        if secrets_data
+        else {}
+    )
+
+    # The selection of the secrets to extract has already been made above
+    if args.atomic:
+        util_lib.write_files_atomically(
+            args.output_path, decrypted_secrets, True, permissions, write_secret
+        )
+    else:
+        if args.skip_unchanged:
+            util_lib.clear_directory(args.output_path)
+        failed = util_lib.write_files(
+            args.output_path, decrypted_secrets, True, permissions, write_secret
         )
-        util_lib.write_files(args.output_path, decrypted_secrets, args.extract_all)
+        # The previous state has already been removed, so that the next run
+        # writes the secrets again instead of keeping the incomplete output.
+        if failed and args.skip_unchanged:
+            raise Exception(
+                f"Failed to write {', '.join(failed)}, "
+                + f"not recording the state of {args.output_path}."
+            )
+
+    if args.skip_unchanged:
+        util_lib.write_state(state_file, digest, args.output_path, state_key)
 
 
 if __name__ == "__main__":
@@ -1,24 +1,31 @@
 import argparse
 import dataclasses
 import glob
+import hashlib
+import io
+import json
 import os
 import traceback
-from collections.abc import Callable, Iterable, Mapping
+from base64 import b64decode, b64encode
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
 from dataclasses import dataclass
-from functools import reduce
 from typing import Any
 
-import yaml
 from nacl.public import PublicKey
 
-from nixostools import ansible_vault_lib, ocb_nixos_lib, secret_lib
+from nixostools import (
+    ansible_vault_lib,
+    keyring_lib,
+    ocb_nixos_lib,
+    secret_lib,
+    yaml_lib,
+)
 from nixostools.secret_lib import (
     CONTENT_KEY,
     DEFAULT_EXTRACT,
     PATH_KEY,
     SECRETS_KEY,
     SERVERS_KEY,
-    UTF8,
 )
 
 
@@ -28,29 +35,61 @@ class ServerSecretData:
     secrets: Mapping
 
     def str_secrets(self) -> str:
-        return yaml.safe_dump(self.secrets)
+        return yaml_lib.safe_dump(self.secrets)
 
 
 @dataclass(frozen=True)
 class PaddedServerSecretData:
     server_name: str
-    padded_secrets: str
+    padded_secrets: bytes
+
+
+# The secrets of a server in the table of contents layout, see split_secrets.
+@dataclass(frozen=True)
+class SplitServerSecretData:
+    server_name: str
+    padded_toc: bytes
+    padded_entries: Mapping[str, bytes]
 
 
 @dataclass(frozen=True)
 class EncryptedSecrets:
     server_name: str
     encrypted_key: str
+    # In the table of contents layout, this holds the encrypted table of contents
     encrypted_secrets: str
+    encrypted_entries: Mapping[str, str] | None = None
 
-    def export_secrets(self) -> Mapping[str, str]:
+    def export_secrets(self) -> Mapping:
         server_name = "server_name"
         # Since we need to hardcode the name of the attribute here,
         # we throw an assertion error if ever the name of the attribute
         # would be changed without it being updated in this function.
         # There doesn't seem to be a way to use reflection
         assert hasattr(self, server_name)
-        return {k: v for k, v in dataclasses.asdict(self).items() if k != server_name}
+        return {
+            k: v
+            for k, v in dataclasses.asdict(self).items()
+            if k != server_name and v is not None
+        }
+
+
+# What we know about the inputs that were used to produce a server's
+# encrypted secrets during a previous run, see encrypt_incremental.
+@dataclass(frozen=True)
+class ManifestEntry:
+    secrets_hash: str
+    public_key: str
+
+
+MANIFEST_VERSION = 1
+
+YAML_FORMAT = "yaml"
+INDEXED_FORMAT = "indexed"
+ENVELOPE_FORMAT = "envelope"
+
+BLOB_LAYOUT = "blob"
+TOC_LAYOUT = "toc"
 
 
 def args_parser() -> argparse.ArgumentParser:
@@ -82,9 +121,93 @@ def args_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--tunnel_config_path", dest="tunnel_config_path", required=True
     )
+    parser.add_argument(
+        "--keyring_cache",
+        dest="keyring_cache",
+        required=False,
+        type=str,
+        help="path to the cache of the public keys compiled from the tunnel config, "
+        + "defaults to a file in the user's cache directory",
+    )
+    parser.add_argument(
+        "--output_format",
+        dest="output_format",
+        choices=[YAML_FORMAT, INDEXED_FORMAT, ENVELOPE_FORMAT],
+        default=YAML_FORMAT,
+        help="format of the generated secrets file, the indexed format allows "
+        + "every server to read its own secrets without parsing the whole file, "
+        + "the envelope format encrypts every secret only once and gives every "
+        + "server a wrapped copy of the keys of its secrets",
+    )
+    parser.add_argument(
+        "--compression",
+        dest="compression",
+        choices=list(secret_lib.PAYLOAD_COMPRESSIONS),
+        required=False,
+        help="compress the secrets of every server before padding them, "
+        + "this requires hosts that understand the framed payload format",
+    )
+    parser.add_argument(
+        "--payload_layout",
+        dest="payload_layout",
+        choices=[BLOB_LAYOUT, TOC_LAYOUT],
+        default=BLOB_LAYOUT,
+        help="encrypt the secrets of every server as a single blob, or as "
+        + "separate entries with an encrypted table of contents, which allows "
+        + "servers to only decrypt the secrets that they extract",
+    )
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="only re-encrypt the secrets of servers whose secrets or public key "
+        + "changed since the previous run, as recorded in the manifest",
+    )
+    parser.add_argument(
+        "--manifest_path",
+        dest="manifest_path",
+        required=False,
+        type=str,
+        help="path to the manifest used by --incremental, "
+        + "defaults to the output path with a .manifest.json extension",
+    )
+    parser.add_argument(
+        "--blobs_directory",
+        dest="blobs_directory",
+        required=False,
+        type=str,
+        help="folder in which we store the stream-encrypted content of binary "
+        + "secrets, defaults to the blobs folder next to the output path",
+    )
+    parser.add_argument(
+        "--servers",
+        dest="servers",
+        required=False,
+        nargs="+",
+        type=str,
+        help="only regenerate the secrets of these servers and splice them into "
+        + "the existing output file, decrypting only the secrets files that "
+        + "target them according to the routing index next to the secrets files, "
+        + "the entries of the decrypted files get refreshed in that index",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        required=False,
+        type=positive_int,
+        help="the number of processes used to decrypt the secrets files "
+        + "and to encrypt the generated secrets, defaults to the number of CPU cores",
+    )
     return parser
 
 
+def positive_int(value: str) -> int:
+    i = int(value)
+    if i < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return i
+
+
 def get_secrets(secrets) -> Iterable[ServerSecretData]:
     def validate_secret(secret_name: str, secret: Any) -> Mapping:
         if not (
@@ -92,7 +215,10 @@ def get_secrets(secrets) -> Iterable[ServerSecretData]:
             # The path should not be empty
             and secret.get(PATH_KEY)
             # Empty strings and lists are falsy in python, so we need to be more explicit here
-            and isinstance(secret.get(CONTENT_KEY), str)
+            and (
+                isinstance(secret.get(CONTENT_KEY), str)
+                or isinstance(secret.get(secret_lib.STREAM_FILE_KEY), str)
+            )
             and isinstance(secret.get(SERVERS_KEY), list)
         ):
             raise Exception(
@@ -103,35 +229,106 @@ def get_secrets(secrets) -> Iterable[ServerSecretData]:
 
     # We filter the secret to only contain the whitelisted keys.
     def filter_secret(secret: Mapping) -> Mapping:
-        whitelist = [PATH_KEY, CONTENT_KEY, DEFAULT_EXTRACT]
+        whitelist = [
+            PATH_KEY,
+            CONTENT_KEY,
+            DEFAULT_EXTRACT,
+            secret_lib.STREAM_FILE_KEY,
+            secret_lib.STREAM_KEY_KEY,
+        ]
         return {k: v for k, v in secret.items() if k in whitelist}
 
+    def entries() -> Iterator[tuple[str, Iterable[str], Mapping]]:
+        for secret_name, secret in secrets.get(SECRETS_KEY, {}).items():
+            validate_secret(secret_name, secret)
+            yield (secret_name, secret.get(SERVERS_KEY, []), filter_secret(secret))
+
     # Build a mapping from every server to its secrets
-    def reducer(
-        server_dict: Mapping[str, ServerSecretData], secret_item
-    ) -> Mapping[str, ServerSecretData]:
-        (secret_name, secret) = secret_item
-        validate_secret(secret_name, secret)
-        out = {**server_dict}
-        for server in secret.get(SERVERS_KEY, []):
-            existing_secrets = out[server].secrets if server in out else {}
-            out[server] = ServerSecretData(
-                server_name=server,
-                secrets={**existing_secrets, secret_name: filter_secret(secret)},
-            )
-        return out
+    return ocb_nixos_lib.invert_server_items(entries(), ServerSecretData)
 
-    init: Mapping[str, ServerSecretData] = {}
-    return reduce(reducer, secrets.get(SECRETS_KEY, {}).items(), init).values()
+
+def is_binary_secret(secret: Any) -> bool:
+    return (
+        isinstance(secret, Mapping)
+        and str(secret.get(secret_lib.BINARY_KEY, "false")).lower() == "true"
+    )
+
+
+# Binary secrets hold their content base64-encoded in the secrets files.
+# We store that content in a stream-encrypted file in the blobs directory,
+# which the servers decrypt into the output file one chunk at a time, and replace
+# the content of the secret by the name of that file and the key to decrypt it.
+# Both are derived from the content with a keyed hash, so that an unchanged
+# binary secret gives the same payload and a file that we do not need to rewrite.
+# Files in the blobs directory that are no longer used get removed.
+# When only some of the secrets files were read, we cannot tell which files
+# are unused, so remove_unused should then be False.
+def stream_binary_secrets(
+    secrets: Mapping, blobs_directory: str, ansible_passwd: str, remove_unused: bool
+) -> Mapping:
+    items = secrets.get(SECRETS_KEY, {})
+    binary_secrets = [
+        name for name, secret in items.items() if is_binary_secret(secret)
+    ]
+    hash_key = secret_lib.derive_hash_key(ansible_passwd) if binary_secrets else b""
+    streamed = dict(items)
+    for name in binary_secrets:
+        streamed[name] = stream_binary_secret(
+            name, items[name], blobs_directory, hash_key
+        )
+    if remove_unused:
+        remove_unused_blobs(
+            blobs_directory,
+            {streamed[name][secret_lib.STREAM_FILE_KEY] for name in binary_secrets},
+        )
+    return {**secrets, SECRETS_KEY: streamed}
+
+
+def stream_binary_secret(
+    name: str, secret: Mapping, blobs_directory: str, hash_key: bytes
+) -> Mapping:
+    if not isinstance(secret.get(CONTENT_KEY), str):
+        raise Exception(f"The binary secret {name} should have a base64 content.")
+    content = b64decode(secret[CONTENT_KEY])
+
+    def digest(person: bytes, size: int) -> bytes:
+        return hashlib.blake2b(
+            content,
+            key=hash_key[: hashlib.blake2b.MAX_KEY_SIZE],
+            person=person,
+            digest_size=size,
+        ).digest()
+
+    stream_file = digest(b"stream-file", 16).hex() + ".bin"
+    key = digest(b"stream-key", secret_lib.STREAM_KEY_SIZE)
+    blob_path = os.path.join(blobs_directory, stream_file)
+    if not os.path.exists(blob_path):
+        os.makedirs(blobs_directory, exist_ok=True)
+        with open(blob_path + ".tmp", "wb") as f:
+            secret_lib.encrypt_stream(key, io.BytesIO(content), f)
+        os.replace(blob_path + ".tmp", blob_path)
+        print(f"Wrote the content of the binary secret {name} to {blob_path}")
+
+    excluded = [CONTENT_KEY, secret_lib.BINARY_KEY]
+    return {
+        **{k: v for k, v in secret.items() if k not in excluded},
+        secret_lib.STREAM_FILE_KEY: stream_file,
+        secret_lib.STREAM_KEY_KEY: b64encode(key).decode(secret_lib.UTF8),
+    }
+
+
+def remove_unused_blobs(blobs_directory: str, used: set[str]) -> None:
+    for blob_path in glob.glob(os.path.join(blobs_directory, "*.bin")):
+        if os.path.basename(blob_path) not in used:
+            os.remove(blob_path)
+            print(f"Removed the unused file {blob_path}")
 
 
 def encrypt_data(data: PaddedServerSecretData, pubkey: PublicKey) -> EncryptedSecrets:
     # Encrypt the secrets with a new key generated on the fly.
     # Only short, random data should ever by encrypted with a public key.
     new_key = secret_lib.generate_symmetric_key()
-    encrypted_secrets = secret_lib.encrypt_symmetric_string(
-        new_key, data.padded_secrets
-    )
+    encrypted_secrets = secret_lib.encrypt_symmetric(new_key, data.padded_secrets)
 
     # Encrypt the newly generated key using the server's public key.
     encrypted_key = secret_lib.encrypt_asymmetric(pubkey, new_key)
@@ -143,58 +340,346 @@ def encrypt_data(data: PaddedServerSecretData, pubkey: PublicKey) -> EncryptedSe
     )
 
 
+# In the table of contents layout, we encrypt the table of contents and
+# every entry separately, but all with the same newly generated key.
+def encrypt_split_data(
+    data: SplitServerSecretData, pubkey: PublicKey
+) -> EncryptedSecrets:
+    new_key = secret_lib.generate_symmetric_key()
+    return EncryptedSecrets(
+        server_name=data.server_name,
+        encrypted_key=secret_lib.encrypt_asymmetric(pubkey, new_key),
+        encrypted_secrets=secret_lib.encrypt_symmetric(new_key, data.padded_toc),
+        encrypted_entries={
+            entry_id: secret_lib.encrypt_symmetric(new_key, padded_entry)
+            for entry_id, padded_entry in data.padded_entries.items()
+        },
+    )
+
+
+def encrypt_server_key(
+    server_key: tuple[PaddedServerSecretData | SplitServerSecretData, PublicKey],
+) -> EncryptedSecrets:
+    (data, pubkey) = server_key
+    if isinstance(data, SplitServerSecretData):
+        return encrypt_split_data(data, pubkey)
+    return encrypt_data(data, pubkey)
+
+
+# Encrypt the secrets of every server using a pool of worker processes.
+# The results are in the same order as the given servers.
+def encrypt_all(
+    server_keys: Sequence[
+        tuple[PaddedServerSecretData | SplitServerSecretData, PublicKey]
+    ],
+    jobs: int | None = None,
+) -> list[EncryptedSecrets]:
+    return ocb_nixos_lib.parallel_map(encrypt_server_key, server_keys, jobs)
+
+
+# We round the max length up to the nearest 10**exp
+# So for instance, for exp = 3, 24869 -> 25000
+# Upper is the part > 10**exp, so for our example
+#   upper(24869) = 20000
+# For lower, we strip everything > 10**exp and then round it up to
+# the nearest multiple of 10**exp, so for our example
+#   lower(24869) = 5000
+def round_up(i: int, exp: int = 3) -> int:
+    if i % 10**exp != 0:
+        exp_high = exp + 1
+        upper: int = i - i % 10**exp_high
+        lower: int = ((i - upper) // 10**exp + 1) * 10**exp
+        return upper + lower
+    else:
+        return i
+
+
 # The only information still communicated by the ciphertext,
 # is the length of the original plaintext.
 # In order to hide the relative amount of secrets accessible by every server,
 # we pad the plaintexts with newlines such that they all have equal length.
 # It is important to look at the length in bytes, rather than
 # the length in characters, to account for variable-width encoding.
-def pad_secrets(data: list[ServerSecretData]) -> Iterable[PaddedServerSecretData]:
-    # We round the max length up to the nearest 10**exp
-    # So for instance, for exp = 3, 24869 -> 25000
-    # Upper is the part > 10**exp, so for our example
-    #   upper(24869) = 20000
-    # For lower, we strip everything > 10**exp and then round it up to
-    # the nearest multiple of 10**exp, so for our example
-    #   lower(24869) = 5000
-    def round_up(i: int, exp: int = 3) -> int:
-        if i % 10**exp != 0:
-            exp_high = exp + 1
-            upper: int = i - i % 10**exp_high
-            lower: int = ((i - upper) // 10**exp + 1) * 10**exp
-            return upper + lower
-        else:
-            return i
+# When compressing, we pad the compressed payloads, the payload header
+# allows the decryption script to strip the padding again.
+# When splicing the secrets of some servers into an existing output file,
+# we pad them to the padding length of that file, given as padding_len.
+def pad_secrets(
+    data: list[ServerSecretData],
+    compression: str | None = None,
+    padding_len: int | None = None,
+) -> list[PaddedServerSecretData]:
+    payloads = [
+        (
+            secret_data.server_name,
+            secret_lib.encode_payload(secret_data.str_secrets(), compression),
+        )
+        for secret_data in data
+    ]
 
-    def reducer(length: int, data: ServerSecretData) -> int:
-        return max(length, len(data.str_secrets().encode(UTF8)))
+    max_len = max((len(payload) for (_, payload) in payloads), default=0)
+    if padding_len is None:
+        padding_len = round_up(max_len)
+    elif max_len > padding_len:
+        raise Exception(
+            "The secrets no longer fit in the padding of the other servers, "
+            + "regenerate the secrets of all servers by running without --servers."
+        )
 
-    padding_len = round_up(reduce(reducer, data, 0))
+    def pad(payload: bytes) -> bytes:
+        return payload.ljust(padding_len, b"\n")
 
-    def pad(secrets: str) -> str:
-        return secrets.ljust(padding_len, "\n")
+    return [
+        PaddedServerSecretData(server_name=server_name, padded_secrets=pad(payload))
+        for (server_name, payload) in payloads
+    ]
 
+
+# Split the secrets of every server into a table of contents and one entry
+# per secret, so that servers can decrypt the table of contents and then
+# only decrypt the entries of the secrets that they actually need.
+# The table of contents lists, for every secret, its entry and
+# its default_extract setting.
+# Like with pad_secrets, all tables of contents are padded to the same length.
+# The number of entries and their sizes are visible, which we limit by
+# padding every entry to the next power of two.
+def split_secrets(
+    data: list[ServerSecretData], compression: str | None = None
+) -> list[SplitServerSecretData]:
+    def split(secret_data: ServerSecretData) -> tuple[str, bytes, Mapping[str, bytes]]:
+        toc: dict[str, Mapping] = {}
+        entries: dict[str, bytes] = {}
+        for index, (secret_name, secret) in enumerate(
+            sorted(secret_data.secrets.items())
+        ):
+            entry_id = str(index)
+            toc[secret_name] = {
+                secret_lib.TOC_ENTRY_KEY: entry_id,
+                **(
+                    {DEFAULT_EXTRACT: secret[DEFAULT_EXTRACT]}
+                    if DEFAULT_EXTRACT in secret
+                    else {}
+                ),
+            }
+            entries[entry_id] = secret_lib.pad_to_power_of_two(
+                secret_lib.encode_payload(
+                    yaml_lib.safe_dump({secret_name: secret}), compression
+                )
+            )
+        return (
+            secret_data.server_name,
+            secret_lib.encode_payload(yaml_lib.safe_dump(toc), compression),
+            entries,
+        )
+
+    splits = [split(secret_data) for secret_data in data]
+    padding_len = round_up(max((len(toc) for (_, toc, _) in splits), default=0))
     return [
-        PaddedServerSecretData(
-            server_name=secret_data.server_name,
-            padded_secrets=pad(secret_data.str_secrets()),
+        SplitServerSecretData(
+            server_name=server_name,
+            padded_toc=toc.ljust(padding_len, b"\n"),
+            padded_entries=entries,
         )
-        for secret_data in data
+        for (server_name, toc, entries) in splits
     ]
 
 
+# Encrypt every secret only once, with its own data key, and wrap that data key
+# with the public key of every server that should have access to the secret.
+# This way, the work and the size of the output scale with the number of
+# secrets plus the number of grants, rather than with their product.
+# The secrets are identified by an opaque id, so that their names stay hidden.
+# Unlike with the other formats, the number of secrets of every server and
+# the sizes of the secrets are visible, which we limit by padding the secrets
+# to the next power of two.
+def encrypt_envelopes(
+    server_keys: list[tuple[ServerSecretData, PublicKey]],
+    compression: str | None = None,
+) -> Mapping:
+    secret_servers: dict[str, list[tuple[str, PublicKey]]] = {}
+    secret_data: dict[str, Mapping] = {}
+    for data, pub_key in server_keys:
+        for secret_name, secret in data.secrets.items():
+            secret_servers.setdefault(secret_name, []).append(
+                (data.server_name, pub_key)
+            )
+            secret_data[secret_name] = secret
+
+    encrypted_secrets: dict[str, str] = {}
+    wrapped_keys: dict[str, dict[str, str]] = {}
+    for index, secret_name in enumerate(sorted(secret_servers)):
+        secret_id = str(index)
+        data_key = secret_lib.generate_symmetric_key()
+        payload = secret_lib.encode_payload(
+            yaml_lib.safe_dump({secret_name: secret_data[secret_name]}), compression
+        )
+        encrypted_secrets[secret_id] = secret_lib.encrypt_symmetric(
+            data_key, secret_lib.pad_to_power_of_two(payload)
+        )
+        for server_name, pub_key in secret_servers[secret_name]:
+            wrapped_keys.setdefault(server_name, {})[secret_id] = (
+                secret_lib.encrypt_asymmetric(pub_key, data_key)
+            )
+
+    print(f"Encrypted {len(encrypted_secrets)} secrets for {len(wrapped_keys)} servers")
+    return {
+        secret_lib.ENVELOPE_FORMAT_KEY: secret_lib.ENVELOPE_FORMAT,
+        secret_lib.ENVELOPE_SECRETS_KEY: encrypted_secrets,
+        secret_lib.ENVELOPE_SERVERS_KEY: wrapped_keys,
+    }
+
+
+# Reuse the encrypted secrets from the previous run for every server
+# for which the padded plaintext and the public key did not change,
+# and only encrypt the secrets of the other servers.
+# This keeps the generated secrets file stable in git and avoids that hosts
+# rewrite their secrets when nothing changed for them.
+# The plaintexts are hashed with a key derived from the vault password,
+# so that the manifest cannot be used to confirm guesses of the secrets.
+def encrypt_incremental(
+    server_keys: list[tuple[PaddedServerSecretData, PublicKey]],
+    hash_key: bytes,
+    previous_secrets: Mapping[str, EncryptedSecrets],
+    previous_manifest: Mapping[str, ManifestEntry],
+    jobs: int | None = None,
+) -> tuple[list[EncryptedSecrets], Mapping[str, ManifestEntry]]:
+    manifest = {
+        data.server_name: ManifestEntry(
+            secrets_hash=secret_lib.keyed_hash(hash_key, data.padded_secrets),
+            public_key=secret_lib.public_key_fingerprint(pub_key),
+        )
+        for (data, pub_key) in server_keys
+    }
+
+    def is_unchanged(server_name: str) -> bool:
+        return (
+            server_name in previous_secrets
+            and previous_manifest.get(server_name) == manifest[server_name]
+        )
+
+    changed = [
+        (data, pub_key)
+        for (data, pub_key) in server_keys
+        if not is_unchanged(data.server_name)
+    ]
+    newly_encrypted = {
+        encrypted.server_name: encrypted for encrypted in encrypt_all(changed, jobs)
+    }
+    encrypted = [
+        newly_encrypted.get(data.server_name) or previous_secrets[data.server_name]
+        for (data, _) in server_keys
+    ]
+    print(
+        f"Re-encrypted {len(changed)} servers, "
+        + f"{len(server_keys) - len(changed)} unchanged"
+    )
+    return (encrypted, manifest)
+
+
+# The padding length used for the secrets in the existing output file.
+# All servers are padded to the same length, see pad_secrets.
+def previous_padding_length(previous_secrets: Mapping[str, EncryptedSecrets]) -> int:
+    lengths = {
+        secret_lib.symmetric_plaintext_length(encrypted.encrypted_secrets)
+        for encrypted in previous_secrets.values()
+    }
+    if len(lengths) != 1:
+        raise Exception(
+            "--servers needs an existing output file with equally padded secrets."
+        )
+    return lengths.pop()
+
+
+# Replace the encrypted secrets of the given servers in the previous output.
+# Servers that no longer have any secrets get removed.
+def splice_secrets(
+    previous_secrets: Mapping[str, EncryptedSecrets],
+    encrypted_secrets: list[EncryptedSecrets],
+    servers: set[str],
+) -> list[EncryptedSecrets]:
+    kept = [
+        encrypted
+        for server_name, encrypted in previous_secrets.items()
+        if server_name not in servers
+    ]
+    print(f"Replaced the secrets of {len(encrypted_secrets)} servers")
+    return kept + encrypted_secrets
+
+
+# Read the encrypted secrets of the previous run, or None if the previous
+# output cannot be reused: the envelope format and the toc payload layout
+# do not hold a single payload per server.
+def read_previous_secrets(output_path: str) -> Mapping[str, EncryptedSecrets] | None:
+    if not os.path.isfile(output_path):
+        return {}
+    if secret_lib.is_indexed_secrets_file(output_path):
+        content = secret_lib.read_all_indexed_secrets(output_path)
+    else:
+        with open(output_path) as f:
+            content = yaml_lib.safe_load(f) or {}
+    if not isinstance(content, Mapping) or secret_lib.is_envelope_secrets(content):
+        return None
+    if not all(
+        isinstance(data, Mapping)
+        and data.keys() == {"encrypted_key", "encrypted_secrets"}
+        for data in content.values()
+    ):
+        return None
+    return {
+        server_name: EncryptedSecrets(server_name=server_name, **data)
+        for server_name, data in content.items()
+    }
+
+
+def read_manifest(manifest_path: str) -> Mapping[str, ManifestEntry]:
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        content = json.load(f)
+    if content.get("version") != MANIFEST_VERSION:
+        print(f"Ignoring manifest {manifest_path} with an unknown version")
+        return {}
+    return {
+        server_name: ManifestEntry(**entry)
+        for server_name, entry in content.get("servers", {}).items()
+    }
+
+
+def write_manifest(manifest: Mapping[str, ManifestEntry], manifest_path: str) -> None:
+    content = {
+        "version": MANIFEST_VERSION,
+        "servers": {
+            server_name: dataclasses.asdict(entry)
+            for server_name, entry in manifest.items()
+        },
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
 def write_secrets(
-    encrypted_secrets_list: list[EncryptedSecrets], output_path: str
+    encrypted_secrets_list: list[EncryptedSecrets],
+    output_path: str,
+    output_format: str = YAML_FORMAT,
 ) -> bool:
-    print(f"Writing generated secrets to {output_path}...")
     content = {
         encrypted_secrets.server_name: encrypted_secrets.export_secrets()
         for encrypted_secrets in encrypted_secrets_list
     }
+    return write_secrets_content(content, output_path, output_format)
+
 
+def write_secrets_content(
+    content: Mapping, output_path: str, output_format: str = YAML_FORMAT
+) -> bool:
+    print(f"Writing generated secrets to {output_path}...")
     try:
-        with open(output_path, "w") as f:
-            yaml.safe_dump(content, f, default_style="|")
+        if output_format == INDEXED_FORMAT:
+            secret_lib.write_indexed_secrets(output_path, content)
+        else:
+            with open(output_path, "w") as f:
+                yaml_lib.safe_dump(content, f, default_style="|")
     except Exception:
         print("ERROR : failed to write generated secrets file")
         print(traceback.format_exc())
@@ -203,56 +688,65 @@ def write_secrets(
     return True
 
 
-def read_secrets_files(secrets_files: Iterable[str], ansible_passwd: str) -> Mapping:
-    def reducer(secrets_data: Mapping, secrets_file: str) -> Mapping:
-        print(f"Parsing {secrets_file}...")
-        new_secrets = ansible_vault_lib.read_vault_file(ansible_passwd, secrets_file)
-
-        # If we detect a duplicate secret, we run our more expensive method to list all duplicates
-        if set(secrets_data.get(SECRETS_KEY, {}).keys()).intersection(
-            set(new_secrets.get(SECRETS_KEY, {}).keys())
-        ):
-            check_duplicate_secrets(secrets_files, ansible_passwd)
-            raise AssertionError("Duplicate secrets found, see above.")
-
-        return ocb_nixos_lib.deep_merge(secrets_data, new_secrets)
-
-    init: Mapping = {SECRETS_KEY: {}}
-    return reduce(reducer, secrets_files, init)
-
-
-def check_duplicate_secrets(secrets_files: Iterable[str], ansible_passwd: str) -> None:
-    print("Finding duplicates...")
-
-    def build_secrets_mapping(secrets_data: Mapping, secrets_file: str) -> Mapping:
-        new_secrets = ansible_vault_lib.read_vault_file(ansible_passwd, secrets_file)
-
-        # Make a mapping of every secret to the files defining a secret with that name
-        secrets = {**secrets_data}
-        for secret in new_secrets.get(SECRETS_KEY, {}).keys():
-            files_found = secrets.get(secret, [])
-            secrets[secret] = files_found + [secrets_file]
-
-        return secrets
-
-    secret: str
-    files: Iterable[str]
-    init: Mapping = {}
-    for secret, files in reduce(build_secrets_mapping, secrets_files, init).items():
-        if len(list(files)) > 1:
-            print(
-                f"ERROR: secret with name '{secret}' is defined in "
-                + f"multiple files: {', '.join(files)}"
-            )
+# The vault files are decrypted in parallel, and then merged one by one
+# in sorted file order, so that the result does not depend on the number of jobs.
+# When update_index is set, the routing index gets updated with the servers
+# targeted by the decrypted files, see ansible_vault_lib.update_routing_index.
+def read_secrets_files(
+    secrets_files: Iterable[str],
+    ansible_passwd: str,
+    jobs: int | None = None,
+    update_index: bool = False,
+) -> Mapping:
+    sorted_files = sorted(secrets_files)
+    print(f"Decrypting {len(sorted_files)} secrets files...")
+    decrypted = ansible_vault_lib.read_vault_files(ansible_passwd, sorted_files, jobs)
+
+    def parsed_files() -> Iterator[tuple[str, Mapping]]:
+        for secrets_file, new_secrets in zip(sorted_files, decrypted):
+            print(f"Parsing {secrets_file}...")
+            yield (secrets_file, new_secrets)
+
+    secrets_index = ocb_nixos_lib.index_items(SECRETS_KEY, parsed_files())
+    check_duplicate_secrets(secrets_index)
+    if update_index:
+        ansible_vault_lib.update_routing_index(dict(zip(sorted_files, decrypted)))
+    return {SECRETS_KEY: secrets_index.items}
+
+
+def check_duplicate_secrets(secrets_index: ocb_nixos_lib.ItemIndex) -> None:
+    duplicates = secrets_index.duplicates()
+    for secret, files in duplicates.items():
+        print(
+            f"ERROR: secret with name '{secret}' is defined in "
+            + f"multiple files: {', '.join(files)}"
+        )
+    if duplicates:
+        raise AssertionError("Duplicate secrets found, see above.")
+
+
+# The secrets files that can contain secrets for the given servers,
+# according to the routing index. Files missing from the index, or changed
+# since they were indexed, are always included.
+def select_secrets_files(secrets_files: Iterable[str], servers: set[str]) -> list[str]:
+    routes = ansible_vault_lib.routed_servers(secrets_files)
+    selected = [
+        secrets_file
+        for secrets_file, routed in routes.items()
+        if routed is None or servers.intersection(routed)
+    ]
+    print(
+        f"Selected {len(selected)} of {len(routes)} secrets files "
+        + f"for {', '.join(sorted(servers))}"
+    )
+    return selected
 
 
-def is_active_secret(tunnels_json: Mapping) -> Callable[[ServerSecretData], bool]:
+def is_active_secret(
+    keyring: keyring_lib.Keyring,
+) -> Callable[[ServerSecretData], bool]:
     def wrapped(data: ServerSecretData) -> bool:
-        return bool(
-            tunnels_json["tunnels"]["per-host"]
-            .get(data.server_name, {})
-            .get("generate_secrets", True)
-        )
+        return keyring.generate_secrets(data.server_name)
 
     return wrapped
 
@@ -260,38 +754,149 @@ def is_active_secret(tunnels_json: Mapping) -> Callable[[ServerSecretData], bool
 def main() -> None:
     args = args_parser().parse_args()
 
-    # First, we fetch and load the secrets data
+    # First, we fetch and load the secrets data.
+    # Only the runs for selected servers, which rely on the routing index,
+    # update it. Full runs, like the CI one, leave the secrets folders untouched.
     secrets_files = glob.glob(
         os.path.join(args.secrets_directory, "**/*-secrets.yml"), recursive=True
     )
 
-    secrets_dict = read_secrets_files(
-        secrets_files, ansible_vault_lib.get_ansible_passwd(args.ansible_vault_passwd)
+    selected_servers = set(args.servers or [])
+    if selected_servers:
+        if args.output_format == ENVELOPE_FORMAT or args.payload_layout == TOC_LAYOUT:
+            raise Exception(
+                "--servers is not supported with the envelope format "
+                + "or the toc payload layout."
+            )
+        secrets_files = select_secrets_files(secrets_files, selected_servers)
+
+    ansible_passwd = ansible_vault_lib.get_ansible_passwd(args.ansible_vault_passwd)
+    secrets_dict = stream_binary_secrets(
+        read_secrets_files(
+            secrets_files,
+            ansible_passwd,
+            args.jobs,
+            update_index=bool(selected_servers),
+        ),
+        args.blobs_directory
+        or os.path.join(os.path.dirname(args.output_path), "blobs"),
+        ansible_passwd,
+        remove_unused=not selected_servers,
     )
 
-    tunnels_json = ocb_nixos_lib.read_json_configs(args.tunnel_config_path)
+    keyring = keyring_lib.load_keyring(args.tunnel_config_path, args.keyring_cache)
 
     secrets = get_secrets(secrets_dict)
     # An iterator can only be consumed once,
     # so we transform it into a list before passing it along
-    active_secrets = list(filter(is_active_secret(tunnels_json), secrets))
-    padded_secrets = pad_secrets(active_secrets)
-
-    write_secrets(
-        [
-            encrypt_data(secrets, pub_key)
-            for secrets in padded_secrets
-            for pub_key in [
-                secret_lib.extract_public_key(
-                    tunnels_json, secrets.server_name, args.tunnel_config_path
-                )
-            ]
-            # pub_key is None when the public_key field is empty
-            # this happens when we are provisioning servers
-            if pub_key
-        ],
-        args.output_path,
+    active_secrets = [
+        data
+        for data in filter(is_active_secret(keyring), secrets)
+        if not selected_servers or data.server_name in selected_servers
+    ]
+    pub_keys = {
+        data.server_name: keyring.curve_public_key(data.server_name)
+        for data in active_secrets
+    }
+
+    if args.output_format == ENVELOPE_FORMAT:
+        if args.incremental:
+            raise Exception("The envelope format does not support --incremental.")
+        write_secrets_content(
+            encrypt_envelopes(
+                [
+                    (data, pub_key)
+                    for data in active_secrets
+                    for pub_key in [pub_keys[data.server_name]]
+                    if pub_key
+                ],
+                args.compression,
+            ),
+            args.output_path,
+        )
+        return
+
+    if args.payload_layout == TOC_LAYOUT:
+        if args.incremental:
+            raise Exception("The toc payload layout does not support --incremental.")
+        write_secrets(
+            encrypt_all(
+                [
+                    (secrets, pub_key)
+                    for secrets in split_secrets(active_secrets, args.compression)
+                    for pub_key in [pub_keys[secrets.server_name]]
+                    if pub_key
+                ],
+                args.jobs,
+            ),
+            args.output_path,
+            args.output_format,
+        )
+        return
+
+    previous_secrets = (
+        read_previous_secrets(args.output_path)
+        if args.incremental or selected_servers
+        else {}
+    )
+    if previous_secrets is None:
+        if selected_servers:
+            raise Exception(
+                f"Cannot splice the secrets of {', '.join(sorted(selected_servers))} "
+                + f"into {args.output_path}, which uses the envelope format or "
+                + "the toc payload layout, run without --servers first."
+            )
+        print(
+            f"Ignoring the previous output {args.output_path}, which uses the "
+            + "envelope format or the toc payload layout"
+        )
+        previous_secrets = {}
+    padded_secrets = pad_secrets(
+        active_secrets,
+        args.compression,
+        previous_padding_length(previous_secrets) if selected_servers else None,
     )
+    server_keys = [
+        (secrets, pub_key)
+        for secrets in padded_secrets
+        for pub_key in [pub_keys[secrets.server_name]]
+        # pub_key is None when the public_key field is empty
+        # this happens when we are provisioning servers
+        if pub_key
+    ]
+
+    if args.incremental:
+        manifest_path = args.manifest_path or (
+            os.path.splitext(args.output_path)[0] + ".manifest.json"
+        )
+        previous_manifest = read_manifest(manifest_path)
+        (encrypted_secrets, manifest) = encrypt_incremental(
+            server_keys,
+            secret_lib.derive_hash_key(ansible_passwd),
+            previous_secrets,
+            previous_manifest,
+            args.jobs,
+        )
+    else:
+        encrypted_secrets = encrypt_all(server_keys, args.jobs)
+
+    if selected_servers:
+        encrypted_secrets = splice_secrets(
+            previous_secrets, encrypted_secrets, selected_servers
+        )
+        if args.incremental:
+            manifest = {
+                **{
+                    server_name: entry
+                    for server_name, entry in previous_manifest.items()
+                    if server_name not in selected_servers
+                },
+                **manifest,
+            }
+
+    if write_secrets(encrypted_secrets, args.output_path, args.output_format):
+        if args.incremental:
+            write_manifest(manifest, manifest_path)
 
 
 if __name__ == "__main__":
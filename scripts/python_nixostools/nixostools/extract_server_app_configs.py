@@ -1,9 +1,7 @@
 import argparse
 import os
 
-import yaml
-
-from nixostools import util_lib
+from nixostools import config_lib, util_lib, yaml_lib
 
 
 def args_parser() -> argparse.ArgumentParser:
@@ -29,6 +27,44 @@ def args_parser() -> argparse.ArgumentParser:
         dest="output_path",
         help="path to the folder where we should output the app configs to",
     )
+    parser.add_argument(
+        "--atomic",
+        action="store_true",
+        dest="atomic",
+        help="write the files to a staging folder and then atomically "
+        + "swap it with the output folder",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        dest="sync",
+        help="only write the files whose content changed and remove the files "
+        + "that are no longer part of the configs, and record the added, changed "
+        + "and removed paths in a JSON file",
+    )
+    parser.add_argument(
+        "--changes_file",
+        type=str,
+        required=False,
+        dest="changes_file",
+        help="file in which --sync records the changed paths, "
+        + "defaults to the output path with a .changes.json suffix",
+    )
+    parser.add_argument(
+        "--owner",
+        type=str,
+        required=False,
+        dest="owner",
+        help="owner (user:group) of the created files and folders",
+    )
+    parser.add_argument(
+        "--acl",
+        type=str,
+        required=False,
+        dest="acl",
+        help="ACL, in the format used by setfacl --set, "
+        + "to set on the created files and folders",
+    )
     return parser
 
 
@@ -48,11 +84,37 @@ def main():
     args = args_parser().parse_args()
     validate_paths(args.configs_path, args.output_path)
     with open(args.configs_path) as f:
-        all_configs = yaml.safe_load(f)
+        all_configs = yaml_lib.safe_load(f)
 
-    configs_data = all_configs.get(args.server_name)
-    if configs_data:
-        util_lib.write_files(args.output_path, configs_data)
+    if config_lib.is_dedup_configs(all_configs):
+        configs_data = (
+            config_lib.dedup_server_configs(all_configs, args.server_name) or {}
+        )
+    else:
+        configs_data = all_configs.get(args.server_name) or {}
+    permissions = util_lib.parse_permissions(args.owner, args.acl)
+    if args.sync:
+        if args.atomic:
+            raise Exception("--sync cannot be combined with --atomic.")
+        changes = util_lib.sync_files(
+            args.output_path, configs_data, permissions=permissions
+        )
+        util_lib.write_changes(
+            args.changes_file or util_lib.default_changes_file(args.output_path),
+            changes,
+        )
+        print(
+            f"{len(changes.added)} added, {len(changes.changed)} changed, "
+            + f"{len(changes.removed)} removed"
+        )
+        if changes.failed:
+            raise Exception(f"Failed to write {', '.join(changes.failed)}.")
+    elif args.atomic:
+        util_lib.write_files_atomically(
+            args.output_path, configs_data, permissions=permissions
+        )
+    else:
+        util_lib.write_files(args.output_path, configs_data, permissions=permissions)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,24 @@
 import argparse
 import glob
 import os
+import time
 import traceback
-from collections.abc import Callable, Iterable, Mapping
-from dataclasses import dataclass
-from functools import reduce
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from dataclasses import dataclass, field
 from typing import Any
 
-import yaml
+from nixostools import config_lib, ocb_nixos_lib, yaml_lib
+from nixostools.config_lib import (
+    CONFIGS_KEY,
+    CONTENT_KEY,
+    PATH_KEY,
+    SERVERS_KEY,
+    TEMPLATE_KEY,
+    VARS_KEY,
+)
 
-from nixostools import ocb_nixos_lib
-from nixostools.config_lib import CONFIGS_KEY, CONTENT_KEY, PATH_KEY, SERVERS_KEY
+PLAIN_FORMAT = "plain"
+DEDUP_FORMAT = "dedup"
 
 
 @dataclass(frozen=True)
@@ -41,60 +49,229 @@ def args_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--tunnel_config_path", dest="tunnel_config_path", required=True
     )
+    parser.add_argument(
+        "--config_snapshot",
+        dest="config_snapshot",
+        required=False,
+        type=str,
+        help="path to the snapshot compiled from the tunnel config, "
+        + "defaults to a file in the user's cache directory",
+    )
+    parser.add_argument(
+        "--parse_cache",
+        dest="parse_cache",
+        required=False,
+        type=str,
+        help="path to the cache of the parsed configs files, "
+        + "defaults to a file in the user's cache directory",
+    )
+    parser.add_argument(
+        "--parse_cache_size",
+        dest="parse_cache_size",
+        required=False,
+        type=positive_int,
+        default=ocb_nixos_lib.DEFAULT_PARSE_CACHE_SIZE,
+        help="the number of parsed files kept in the parse cache, "
+        + "the least recently used ones get evicted",
+    )
+    parser.add_argument(
+        "--parse_cache_stats",
+        dest="parse_cache_stats",
+        action="store_true",
+        help="report the hit rate of the parse cache",
+    )
+    parser.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="keep running and regenerate the output whenever a configs file "
+        + "changes, only re-parsing the changed files",
+    )
+    parser.add_argument(
+        "--watch_interval",
+        dest="watch_interval",
+        required=False,
+        type=float,
+        default=0.5,
+        help="the number of seconds between two checks for changes with --watch",
+    )
+    parser.add_argument(
+        "--output_format",
+        dest="output_format",
+        choices=[PLAIN_FORMAT, DEDUP_FORMAT],
+        default=PLAIN_FORMAT,
+        help="format of the generated configs file, the dedup format stores "
+        + "every distinct content only once, instead of once for every server, "
+        + "this requires hosts that understand this format",
+    )
     return parser
 
 
-def get_configs(configs) -> Iterable[ServerConfigData]:
-    def validate_config(config_name: str, config: Any) -> Mapping:
+def positive_int(value: str) -> int:
+    i = int(value)
+    if i < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return i
+
+
+def validate_config(config_name: str, config: Any) -> Mapping:
+    if not (
+        isinstance(config, Mapping)
+        and config.get(PATH_KEY)
+        and (config.get(CONTENT_KEY) or config.get(TEMPLATE_KEY))
+        and config.get(SERVERS_KEY)
+    ):
+        raise Exception(
+            f"The config {config_name} should be a mapping containing "
+            + f'the mandatory fields "{PATH_KEY}", "{CONTENT_KEY}" and "{SERVERS_KEY}", '
+            + f'or "{TEMPLATE_KEY}" instead of "{CONTENT_KEY}".'
+        )
+    if TEMPLATE_KEY in config:
+        if CONTENT_KEY in config:
+            raise Exception(
+                f'The config {config_name} cannot have both "{CONTENT_KEY}" '
+                + f'and "{TEMPLATE_KEY}".'
+            )
+        if not isinstance(config[TEMPLATE_KEY], str):
+            raise Exception(
+                f'The "{TEMPLATE_KEY}" of the config {config_name} should be a string.'
+            )
+        server_vars = config.get(VARS_KEY) or {}
         if not (
-            isinstance(config, Mapping)
-            and config.get(PATH_KEY)
-            and config.get(CONTENT_KEY)
-            and config.get(SERVERS_KEY)
+            isinstance(server_vars, Mapping)
+            and all(
+                isinstance(variables or {}, Mapping)
+                for variables in server_vars.values()
+            )
         ):
             raise Exception(
-                f"The config {config_name} should be a mapping containing "
-                + f'the mandatory fields "{PATH_KEY}", "{CONTENT_KEY}" and "{SERVERS_KEY}".'
+                f'The "{VARS_KEY}" of the config {config_name} should map '
+                + "server names to mappings of their variables."
             )
-        return config
+        try:
+            config_lib.compile_template(config[TEMPLATE_KEY])
+        except ValueError as e:
+            raise Exception(f"The config {config_name} has an invalid template: {e}")
+    return config
+
+
+# Validate all configs of a parsed configs file, before it goes into the parse cache
+def validate_configs_file(configs: Any) -> None:
+    if not isinstance(configs, Mapping):
+        raise Exception("A configs file should contain a mapping.")
+    for config_name, config in (configs.get(CONFIGS_KEY) or {}).items():
+        validate_config(config_name, config)
+
+
+# We filter the config to only contain the whitelisted keys.
+def filter_config(config: Mapping) -> Mapping:
+    whitelist = [PATH_KEY, CONTENT_KEY, TEMPLATE_KEY, VARS_KEY]
+    return {k: v for k, v in config.items() if k in whitelist}
 
-    # We filter the config to only contain the whitelisted keys.
-    def filter_config(config: Mapping) -> Mapping:
-        whitelist = [PATH_KEY, CONTENT_KEY]
-        return {k: v for k, v in config.items() if k in whitelist}
+
+def get_configs(configs) -> Iterable[ServerConfigData]:
+    def entries() -> Iterator[tuple[str, Iterable[str], Mapping]]:
+        for config_name, config in configs.get(CONFIGS_KEY, {}).items():
+            validate_config(config_name, config)
+            yield (config_name, config.get(SERVERS_KEY, []), filter_config(config))
 
     # Build a mapping from every server to its configs
-    def reducer(
-        server_dict: Mapping[str, ServerConfigData], config_item
-    ) -> Mapping[str, ServerConfigData]:
-        (config_name, config) = config_item
-        validate_config(config_name, config)
-        out = {**server_dict}
-        for server in config.get(SERVERS_KEY, []):
-            existing_configs = out[server].configs if server in out else {}
-            out[server] = ServerConfigData(
-                server_name=server,
-                configs={**existing_configs, config_name: filter_config(config)},
-            )
-        return out
+    return ocb_nixos_lib.invert_server_items(entries(), ServerConfigData)
 
-    init: Mapping[str, ServerConfigData] = {}
-    return reduce(reducer, configs.get(CONFIGS_KEY, {}).items(), init).values()
 
+# The variables available to the templates of a server: the scalar fields
+# of its tunnel config, e.g. remote_forward_port, and its name as hostname.
+def host_variables(
+    snapshot: ocb_nixos_lib.ConfigSnapshot,
+) -> Callable[[str], Mapping]:
+    def wrapped(server_name: str) -> Mapping:
+        tunnel = snapshot.record("tunnels", server_name) or {}
+        return {
+            **{k: v for k, v in tunnel.items() if isinstance(v, str | int | float)},
+            "hostname": server_name,
+        }
 
-def str_presenter(dumper, data):
-    if len(data.splitlines()) > 1:  # check for multiline string
-        return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
-    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+    return wrapped
 
 
-def write_configs(configs_list: list[ServerConfigData], output_path: str) -> bool:
+# Render a templated config for the given server, with the variables of the
+# server from the config's vars taking precedence over the host variables.
+def render_config(
+    config_name: str,
+    config: Mapping,
+    server_name: str,
+    variables: Callable[[str], Mapping],
+) -> Mapping:
+    if TEMPLATE_KEY not in config:
+        return config
+    server_vars = (config.get(VARS_KEY) or {}).get(server_name) or {}
+    try:
+        content = config_lib.render_template(
+            config[TEMPLATE_KEY], {**variables(server_name), **server_vars}
+        )
+    except KeyError as e:
+        raise Exception(
+            f"The template of the config {config_name} uses the variable {e}, "
+            + f"which is not defined for {server_name}."
+        )
+    return {PATH_KEY: config[PATH_KEY], CONTENT_KEY: content}
+
+
+def render_configs(
+    data: ServerConfigData, variables: Callable[[str], Mapping]
+) -> ServerConfigData:
+    return ServerConfigData(
+        server_name=data.server_name,
+        configs={
+            config_name: render_config(config_name, config, data.server_name, variables)
+            for config_name, config in data.configs.items()
+        },
+    )
+
+
+# Store every distinct content once, in a table keyed by its hash,
+# and replace the content of every config by a reference to it.
+def dedup_configs(configs_list: list[ServerConfigData]) -> Mapping:
+    blobs: dict[str, str] = {}
+
+    def dedup(config: Mapping) -> Mapping:
+        blob = config_lib.content_hash(config[CONTENT_KEY])
+        blobs[blob] = config[CONTENT_KEY]
+        return {
+            **{k: v for k, v in config.items() if k != CONTENT_KEY},
+            config_lib.BLOB_KEY: blob,
+        }
+
+    servers = {
+        configs.server_name: {
+            config_name: dedup(config)
+            for config_name, config in configs.str_configs().items()
+        }
+        for configs in configs_list
+    }
+    print(f"Stored {len(blobs)} distinct contents for {len(servers)} servers")
+    return {
+        config_lib.DEDUP_FORMAT_KEY: config_lib.DEDUP_FORMAT,
+        config_lib.DEDUP_BLOBS_KEY: blobs,
+        config_lib.DEDUP_SERVERS_KEY: servers,
+    }
+
+
+def write_configs(
+    configs_list: list[ServerConfigData],
+    output_path: str,
+    output_format: str = PLAIN_FORMAT,
+) -> bool:
     print(f"Writing generated app configs to {output_path}...")
-    content = {configs.server_name: configs.str_configs() for configs in configs_list}
-    yaml.representer.SafeRepresenter.add_representer(str, str_presenter)
+    if output_format == DEDUP_FORMAT:
+        content = dedup_configs(configs_list)
+    else:
+        content = {
+            configs.server_name: configs.str_configs() for configs in configs_list
+        }
     try:
         with open(output_path, "w") as f:
-            yaml.safe_dump(content, f)
+            yaml_lib.safe_dump(content, f, literal=True)
     except Exception:
         print("ERROR : failed to write generated app configs file")
         print(traceback.format_exc())
@@ -103,79 +280,325 @@ def write_configs(configs_list: list[ServerConfigData], output_path: str) -> boo
     return True
 
 
-def read_config_file(config_file_name: str) -> Mapping:
+def read_config_file(
+    config_file_name: str, parse_cache: ocb_nixos_lib.ParseCache | None = None
+) -> Mapping:
     if os.path.isfile(config_file_name):
+        if parse_cache:
+            return parse_cache.load(config_file_name, validate_configs_file)
         with open(config_file_name) as f:
-            return yaml.safe_load(f)
+            return yaml_lib.safe_load(f)
     else:
         raise FileNotFoundError(f"App Config file: ({config_file_name}): no such file!")
 
 
-def read_configs_files(configs_files: Iterable[str]) -> Mapping:
-    def reducer(configs_data: Mapping, configs_file: str) -> Mapping:
-        print(f"Parsing {configs_file}...")
-        new_configs = read_config_file(configs_file)
-        # If we detect a duplicate config, we run our more expensive method to list all duplicates
-        if set(configs_data.get(CONFIGS_KEY, {}).keys()).intersection(
-            set(new_configs.get(CONFIGS_KEY, {}).keys())
-        ):
-            check_duplicate_configs(new_configs)
-            raise AssertionError("Duplicate app configs found, see above.")
-
-        return ocb_nixos_lib.deep_merge(configs_data, new_configs)
+def read_configs_files(
+    configs_files: Iterable[str], parse_cache: ocb_nixos_lib.ParseCache | None = None
+) -> Mapping:
+    def parsed_files() -> Iterator[tuple[str, Mapping]]:
+        for configs_file in sorted(configs_files):
+            print(f"Parsing {configs_file}...")
+            yield (configs_file, read_config_file(configs_file, parse_cache))
 
-    init: Mapping = {CONFIGS_KEY: {}}
-    return reduce(reducer, configs_files, init)
+    configs_index = ocb_nixos_lib.index_items(CONFIGS_KEY, parsed_files())
+    check_duplicate_configs(configs_index)
+    return {CONFIGS_KEY: configs_index.items}
 
 
-def check_duplicate_configs(configs_files: Iterable[str]) -> None:
-    print("Finding duplicates...")
+def check_duplicate_configs(configs_index: ocb_nixos_lib.ItemIndex) -> None:
+    duplicates = configs_index.duplicates()
+    for config, files in duplicates.items():
+        print(
+            f"ERROR: app config with name '{config}' is defined in "
+            + f"multiple files: {', '.join(files)}"
+        )
+    if duplicates:
+        raise AssertionError("Duplicate app configs found, see above.")
 
-    def build_configs_mapping(configs_data: Mapping, configs_file: str) -> Mapping:
-        new_configs = read_config_file(configs_file)
 
-        # Make a mapping of every config to the files defining a config with that name
-        configs = {**configs_data}
-        for config in new_configs.get(CONFIGS_KEY, {}).keys():
-            files_found = configs.get(config, [])
-            configs[config] = files_found + [configs_file]
+def is_active_server(
+    snapshot: ocb_nixos_lib.ConfigSnapshot,
+) -> Callable[[str], bool]:
+    def wrapped(server_name: str) -> bool:
+        return bool(
+            (snapshot.record("tunnels", server_name) or {}).get(
+                "generate_configs", True
+            )
+        )
 
-        return configs
+    return wrapped
 
-    config: str
-    files: Iterable[str]
-    init: Mapping = {}
-    for config, files in reduce(build_configs_mapping, configs_files, init).items():
-        if len(list(files)) > 1:
-            print(
-                f"ERROR: app config with name '{config}' is defined in "
-                + f"multiple files: {', '.join(files)}"
-            )
 
+def is_active_config(
+    snapshot: ocb_nixos_lib.ConfigSnapshot,
+) -> Callable[[ServerConfigData], bool]:
+    is_active = is_active_server(snapshot)
 
-def is_active_config(tunnels_json: Mapping) -> Callable[[ServerConfigData], bool]:
     def wrapped(data: ServerConfigData) -> bool:
-        return bool(
-            tunnels_json["tunnels"]["per-host"]
-            .get(data.server_name, {})
-            .get("generate_configs", True)
-        )
+        return is_active(data.server_name)
 
     return wrapped
 
 
+def find_configs_files(configs_directory: str) -> list[str]:
+    return glob.glob(
+        os.path.join(configs_directory, "**/*-configs.yml"), recursive=True
+    )
+
+
+# The state kept in memory by --watch, see watch_configs: the configs defined
+# in every configs file, the file defining every config, the YAML text of every
+# config, the configs of every server, and the YAML text of every active server.
+# The output file is the concatenation of the YAML texts of all servers,
+# which is the same as dumping the configs of all servers at once,
+# since the dumper sorts the servers and their configs.
+@dataclass
+class WatchState:
+    stamps: dict[str, tuple[int, int]] = field(default_factory=dict)
+    files: dict[str, Mapping] = field(default_factory=dict)
+    sources: dict[str, str] = field(default_factory=dict)
+    texts: dict[str, str] = field(default_factory=dict)
+    rendered: dict[str, dict[str, str]] = field(default_factory=dict)
+    servers: dict[str, dict[str, Mapping]] = field(default_factory=dict)
+    fragments: dict[str, str] = field(default_factory=dict)
+
+
+# The YAML text of a config as it appears in the output file, below the name
+# of a server. Since it does not depend on the server, we dump every config
+# that is not templated only once, however many servers it targets.
+def config_text(config_name: str, config: Mapping) -> str:
+    text = yaml_lib.safe_dump({"server": {config_name: config}}, literal=True)
+    return text.removeprefix("server:\n")
+
+
+# The YAML text of the name of a server, with the quotes it might need.
+def server_text(server: str) -> str:
+    return yaml_lib.safe_dump({server: None}).removesuffix(" null\n") + "\n"
+
+
+# The modification time and size of every configs file,
+# which tell us which files changed since the previous check.
+def scan_configs_files(configs_directory: str) -> dict[str, tuple[int, int]]:
+    stamps = {}
+    for path in find_configs_files(configs_directory):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stamps[path] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+
+# Parse the files that changed since the state was last updated, and update
+# the configs of the servers targeted by the previous or the new configs
+# of these files. Returns these servers.
+# Templated configs get rendered for each of their active servers up front,
+# so that if one of the files is invalid or one of its templates cannot be
+# rendered, nothing gets updated.
+def update_watch_state(
+    state: WatchState,
+    stamps: Mapping[str, tuple[int, int]],
+    is_active: Callable[[str], bool],
+    variables: Callable[[str], Mapping],
+    parse_cache: ocb_nixos_lib.ParseCache | None = None,
+) -> set[str]:
+    changed = sorted(
+        path
+        for path in stamps.keys() | state.stamps.keys()
+        if stamps.get(path) != state.stamps.get(path)
+    )
+    new_files = {
+        path: (read_config_file(path, parse_cache).get(CONFIGS_KEY) or {})
+        if path in stamps
+        else {}
+        for path in changed
+    }
+
+    sources = {
+        name: path for name, path in state.sources.items() if path not in new_files
+    }
+    for path, configs in new_files.items():
+        for config_name, config in configs.items():
+            validate_config(config_name, config)
+            if config_name in sources:
+                raise Exception(
+                    f"app config with name '{config_name}' is defined in "
+                    + f"multiple files: {sources[config_name]}, {path}"
+                )
+            sources[config_name] = path
+    rendered = {
+        config_name: {
+            server: config_text(
+                config_name, render_config(config_name, config, server, variables)
+            )
+            for server in config[SERVERS_KEY]
+            if is_active(server)
+        }
+        for configs in new_files.values()
+        for config_name, config in configs.items()
+        if TEMPLATE_KEY in config
+    }
+
+    servers = set()
+    for path, configs in new_files.items():
+        for config_name, config in state.files.pop(path, {}).items():
+            state.texts.pop(config_name, None)
+            state.rendered.pop(config_name, None)
+            for server in config[SERVERS_KEY]:
+                state.servers[server].pop(config_name, None)
+                servers.add(server)
+        for config_name, config in configs.items():
+            filtered = filter_config(config)
+            if config_name in rendered:
+                state.rendered[config_name] = rendered[config_name]
+            else:
+                state.texts[config_name] = config_text(config_name, filtered)
+            for server in config[SERVERS_KEY]:
+                state.servers.setdefault(server, {})[config_name] = filtered
+                servers.add(server)
+        if path in stamps:
+            state.files[path] = configs
+    state.sources = sources
+    state.stamps = dict(stamps)
+
+    for server in servers:
+        if not state.servers.get(server):
+            state.servers.pop(server, None)
+    return servers
+
+
+def update_fragments(
+    state: WatchState, servers: Iterable[str], is_active: Callable[[str], bool]
+) -> None:
+    def text(server: str, config_name: str) -> str:
+        if config_name in state.texts:
+            return state.texts[config_name]
+        return state.rendered[config_name][server]
+
+    for server in servers:
+        configs = state.servers.get(server)
+        if configs and is_active(server):
+            state.fragments[server] = server_text(server) + "".join(
+                text(server, config_name) for config_name in sorted(configs)
+            )
+        else:
+            state.fragments.pop(server, None)
+
+
+# Atomically replace the output file, so that readers never see a partial file.
+def write_watch_output(state: WatchState, output_path: str) -> None:
+    content = "".join(
+        state.fragments[server] for server in sorted(state.fragments)
+    ) or yaml_lib.safe_dump({})
+    with open(output_path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(output_path + ".tmp", output_path)
+
+
+def regenerate_configs(
+    state: WatchState,
+    stamps: Mapping[str, tuple[int, int]],
+    output_path: str,
+    parse_cache: ocb_nixos_lib.ParseCache | None,
+    is_active: Callable[[str], bool],
+    variables: Callable[[str], Mapping],
+) -> None:
+    start = time.perf_counter()
+    try:
+        servers = update_watch_state(state, stamps, is_active, variables, parse_cache)
+    except Exception as e:
+        print(f"ERROR: {e}")
+        print("Keeping the previous app configs until the next change.")
+        return
+    finally:
+        if parse_cache:
+            parse_cache.commit()
+    update_fragments(state, servers, is_active)
+    write_watch_output(state, output_path)
+    print(
+        f"Regenerated the app configs of {len(servers)} servers "
+        + f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+    )
+
+
+# Regenerate the output whenever a configs file gets added, changed or removed.
+# We poll the modification times of the files, which is cheap enough for
+# the size of the configs tree and does not need any extra dependency.
+def watch_configs(
+    configs_directory: str,
+    output_path: str,
+    interval: float,
+    parse_cache: ocb_nixos_lib.ParseCache | None,
+    is_active: Callable[[str], bool],
+    variables: Callable[[str], Mapping],
+) -> None:
+    state = WatchState()
+    # The stamps of the latest attempt, which differ from the ones of the state
+    # when the latest change could not be applied.
+    stamps = scan_configs_files(configs_directory)
+    regenerate_configs(state, stamps, output_path, parse_cache, is_active, variables)
+    print(f"Watching {configs_directory} for changes, press Ctrl+C to stop...")
+    try:
+        while True:
+            time.sleep(interval)
+            new_stamps = scan_configs_files(configs_directory)
+            if new_stamps != stamps:
+                stamps = new_stamps
+                regenerate_configs(
+                    state, stamps, output_path, parse_cache, is_active, variables
+                )
+    except KeyboardInterrupt:
+        pass
+
+
 def main() -> None:
     args = args_parser().parse_args()
 
-    ### First, we fetch and load the configs data
-    configs_files = glob.glob(
-        os.path.join(args.configs_directory, "**/*-configs.yml"), recursive=True
+    parse_cache_path = args.parse_cache or ocb_nixos_lib.default_cache_file(
+        "parse", ".sqlite", [args.configs_directory]
     )
-    configs_dict = read_configs_files(configs_files)
-    tunnels_json = ocb_nixos_lib.read_json_configs(args.tunnel_config_path)
+
+    if args.watch:
+        if args.output_format != PLAIN_FORMAT:
+            raise Exception("--watch only supports the plain output format.")
+        with (
+            ocb_nixos_lib.open_parse_cache(
+                parse_cache_path, args.parse_cache_size
+            ) as parse_cache,
+            ocb_nixos_lib.open_snapshot(
+                {ocb_nixos_lib.TUNNELS_SOURCE: args.tunnel_config_path},
+                args.config_snapshot,
+            ) as snapshot,
+        ):
+            watch_configs(
+                args.configs_directory,
+                args.output_path,
+                args.watch_interval,
+                parse_cache,
+                is_active_server(snapshot),
+                host_variables(snapshot),
+            )
+        return
+
+    ### First, we fetch and load the configs data
+    configs_files = find_configs_files(args.configs_directory)
+    with ocb_nixos_lib.open_parse_cache(
+        parse_cache_path, args.parse_cache_size
+    ) as parse_cache:
+        configs_dict = read_configs_files(configs_files, parse_cache)
+    if args.parse_cache_stats:
+        print(parse_cache.format_stats())
     configs = get_configs(configs_dict)
-    active_configs = list(filter(is_active_config(tunnels_json), configs))
-    write_configs(active_configs, args.output_path)
+    with ocb_nixos_lib.open_snapshot(
+        {ocb_nixos_lib.TUNNELS_SOURCE: args.tunnel_config_path},
+        args.config_snapshot,
+    ) as snapshot:
+        variables = host_variables(snapshot)
+        active_configs = [
+            render_configs(data, variables)
+            for data in filter(is_active_config(snapshot), configs)
+        ]
+    write_configs(active_configs, args.output_path, args.output_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+import dataclasses
+import json
+import os
+import tempfile
+from base64 import b64decode, b64encode
+from collections.abc import Mapping
+from dataclasses import dataclass
+
+from nacl.public import PublicKey
+
+from nixostools import ocb_nixos_lib, secret_lib
+
+KEYRING_VERSION = 1
+GENERATE_SECRETS_KEY = "generate_secrets"
+
+
+# The key of a single host, as defined in the tunnels JSON data.
+# Keys that cannot be parsed are recorded with an error, which only gets raised
+# when the key is actually used, so that a broken key does not prevent
+# the tools from working for the other hosts.
+@dataclass(frozen=True)
+class HostKey:
+    # The OpenSSH public key as found in the tunnels JSON data
+    public_key: str
+    generate_secrets: bool
+    # The base64-encoded Curve25519 public key, None if the public key is empty
+    curve_public_key: str | None
+    error: str | None
+
+
+# The keys of all hosts defined in the tunnels JSON data,
+# compiled once and cached until the JSON files change.
+@dataclass(frozen=True)
+class Keyring:
+    source: str
+    hosts: Mapping[str, HostKey]
+
+    def host(self, server: str) -> HostKey:
+        host = self.hosts.get(server)
+        if not host:
+            raise Exception(f'Server {server} not found in "{self.source}".')
+        return host
+
+    # The same as secret_lib.extract_public_key, without parsing the key again.
+    def curve_public_key(self, server: str) -> PublicKey | None:
+        host = self.host(server)
+        if host.error:
+            raise Exception(host.error)
+        if not host.curve_public_key:
+            return None
+        return PublicKey(b64decode(host.curve_public_key))
+
+    def generate_secrets(self, server: str) -> bool:
+        host = self.hosts.get(server)
+        return host.generate_secrets if host else True
+
+
+# The default location of the keyring cache of the given tunnels JSON data.
+def default_keyring_cache(tunnel_config_path: str) -> str:
+    return ocb_nixos_lib.default_cache_file("keyring", ".json", [tunnel_config_path])
+
+
+def compile_host_key(server: str, tunnel_data: Mapping) -> HostKey:
+    public_key = tunnel_data.get(secret_lib.PUBLIC_KEY_KEY, "")
+    curve_public_key = None
+    error = None
+    try:
+        pubkey = secret_lib.parse_openssh_public_key(public_key, server)
+        if pubkey:
+            curve_public_key = b64encode(bytes(pubkey)).decode(secret_lib.UTF8)
+    except Exception as e:
+        error = str(e) or f"Error parsing the public key for server {server}."
+    return HostKey(
+        public_key=public_key,
+        generate_secrets=bool(tunnel_data.get(GENERATE_SECRETS_KEY, True)),
+        curve_public_key=curve_public_key,
+        error=error,
+    )
+
+
+def compile_keyring(tunnel_config_path: str) -> Keyring:
+    with ocb_nixos_lib.open_snapshot(
+        {ocb_nixos_lib.TUNNELS_SOURCE: tunnel_config_path}
+    ) as snapshot:
+        per_host = snapshot.records("tunnels")
+    return Keyring(
+        source=tunnel_config_path,
+        hosts={
+            server: compile_host_key(server, tunnel_data)
+            for server, tunnel_data in per_host.items()
+        },
+    )
+
+
+def read_keyring_cache(
+    cache_path: str, tunnel_config_path: str, sources: Mapping[str, str]
+) -> Keyring | None:
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != KEYRING_VERSION or cache.get("sources") != sources:
+        return None
+    return Keyring(
+        source=tunnel_config_path,
+        hosts={
+            server: HostKey(**host_key) for server, host_key in cache["hosts"].items()
+        },
+    )
+
+
+# Failing to write the cache only makes the next run slower,
+# so we do not treat it as an error.
+def write_keyring_cache(
+    cache_path: str, keyring: Keyring, sources: Mapping[str, str]
+) -> None:
+    cache = {
+        "version": KEYRING_VERSION,
+        "sources": sources,
+        "hosts": {
+            server: dataclasses.asdict(host_key)
+            for server, host_key in keyring.hosts.items()
+        },
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(cache_path), delete=False
+        ) as f:
+            json.dump(cache, f, sort_keys=True)
+        os.replace(f.name, cache_path)
+    except OSError as e:
+        print(f"WARNING: could not write the keyring cache {cache_path}: {e}")
+
+
+# Load the keyring of the given tunnels JSON data, from the cache if none of
+# the JSON files changed since it was written, and otherwise compile it
+# and update the cache.
+def load_keyring(tunnel_config_path: str, cache_path: str | None = None) -> Keyring:
+    cache_path = cache_path or default_keyring_cache(tunnel_config_path)
+    sources = ocb_nixos_lib.json_config_digests(tunnel_config_path)
+    keyring = read_keyring_cache(cache_path, tunnel_config_path, sources)
+    if keyring:
+        return keyring
+    keyring = compile_keyring(tunnel_config_path)
+    write_keyring_cache(cache_path, keyring, sources)
+    return keyring
@@ -1,60 +1,481 @@
+import hashlib
 import json
 import os
 import os.path
-from collections.abc import Mapping
-from functools import reduce
+import sqlite3
+import tempfile
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
+from typing import Any, TypeVar
+
+import yaml
+
+from nixostools import yaml_lib
+
+A = TypeVar("A")
+T = TypeVar("T")
+
+# The number of tasks per worker process that parallel_map keeps in flight
+PARALLEL_MAP_TASKS_PER_WORKER = 2
+
+SNAPSHOT_VERSION = 1
+# The sources of a config snapshot, by the name under which we pass their path
+TUNNELS_SOURCE = "tunnels"
+USERS_SOURCE = "users"
+KEYS_SOURCE = "keys"
+# The kinds of records indexed in a config snapshot, with the source
+# and the key path of the mapping holding the records of that kind
+SNAPSHOT_KINDS: Mapping[str, tuple[str, tuple[str, ...]]] = {
+    "tunnels": (TUNNELS_SOURCE, ("tunnels", "per-host")),
+    "users": (USERS_SOURCE, ("users", "per-host")),
+    "roles": (USERS_SOURCE, ("users", "roles")),
+    "keys": (KEYS_SOURCE, ("keys",)),
+}
+
+PARSE_CACHE_VERSION = 1
+# The number of parsed files kept in the parse cache, see ParseCache
+DEFAULT_PARSE_CACHE_SIZE = 10000
+
+
+# The named items (secrets, app configs, ...) defined in a set of files,
+# together with the files defining every item name.
+@dataclass(frozen=True)
+class ItemIndex:
+    items: Mapping[str, Any]
+    sources: Mapping[str, list[str]]
+
+    def duplicates(self) -> Mapping[str, list[str]]:
+        return {name: files for name, files in self.sources.items() if len(files) > 1}
 
 
 def read_json_configs(config_path: str) -> Mapping:
     if os.path.isfile(config_path):
         with open(config_path) as f:
             return json.load(f)
+    return merge_all(
+        [read_json_configs(path) for path in json_config_files(config_path)]
+    )
+
+
+# The JSON files read by read_json_configs, which is either the given file,
+# or the JSON files in the given directory.
+# We sort the files, so that merged lists do not depend on the order
+# in which the file system lists the files.
+def json_config_files(config_path: str) -> list[str]:
+    if os.path.isfile(config_path):
+        return [config_path]
     elif os.path.isdir(config_path):
-        json_configs = [
-            read_json_configs(f.path)
-            for f in os.scandir(config_path)
+        return [
+            f.path
+            for f in sorted(os.scandir(config_path), key=lambda f: f.name)
             if f.is_file() and os.path.splitext(f.name)[1] == ".json"
         ]
-        return reduce(deep_merge, json_configs, {})
     else:
         raise FileNotFoundError(
             f"The given config path ({config_path}) does not exist!"
         )
 
 
+# Digests of the JSON files read by read_json_configs, by file name.
+def json_config_digests(config_path: str) -> Mapping[str, str]:
+    digests = {}
+    for path in json_config_files(config_path):
+        with open(path, "rb") as f:
+            digests[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+# The default location of a file caching data compiled from the given paths,
+# in the user's cache directory, since the config repo is not the place for it.
+def default_cache_file(prefix: str, extension: str, paths: Iterable[str]) -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    name = hashlib.sha256(
+        "\0".join(os.path.abspath(path) for path in paths).encode()
+    ).hexdigest()
+    return os.path.join(cache_home, "nixostools", f"{prefix}-{name[:16]}{extension}")
+
+
 def deep_merge(d1: Mapping, d2: Mapping) -> Mapping:
-    out: dict = {}
-
-    for key in set(d1.keys()).union(set(d2.keys())):
-        if (
-            key in d1
-            and key in d2
-            and not (
-                isinstance(d1[key], type(d2[key])) or isinstance(d2[key], type(d1[key]))
-            )
-        ):
+    return merge_all([d1, d2])
+
+
+# Merge any number of mappings in a single pass:
+# mappings are merged key by key, lists are concatenated in the order of the inputs,
+# and keys that are None in all inputs stay None.
+# A value that occurs in a single input is used as is, without copying it,
+# so the result shares those subtrees with the inputs.
+def merge_all(mappings: Sequence[Mapping]) -> Mapping:
+    return merge_values(list(mappings), ()) if mappings else {}
+
+
+def merge_values(values: list[Any], path: tuple[str, ...]) -> Any:
+    if len(values) == 1:
+        return values[0]
+
+    first = values[0]
+    for value in values[1:]:
+        if not (isinstance(first, type(value)) or isinstance(value, type(first))):
             raise AssertionError(
-                f"The types of the values for key '{key}' are not the same!"
+                f"The types of the values for key '{format_key_path(path)}' "
+                + "are not the same!"
+            )
+
+    if isinstance(first, Mapping):
+        grouped: dict[str, list[Any]] = {}
+        for mapping in values:
+            for key, value in mapping.items():
+                grouped.setdefault(key, []).append(value)
+        return {
+            key: merge_values(key_values, (*path, key))
+            for key, key_values in grouped.items()
+        }
+    # careful, str is a subset of Iterable!
+    elif isinstance(first, list):
+        return [item for value in values for item in value]
+    elif first is None:
+        return None
+    # In other cases, we do not know what to do...
+    else:
+        raise ValueError(
+            "Unmergeable type found during merge, "
+            + f"key: '{format_key_path(path)}', type: '{type(first)}'"
+        )
+
+
+def format_key_path(path: tuple[str, ...]) -> str:
+    return ".".join(path)
+
+
+# Collect the items defined under the given key in every parsed file,
+# recording which files define every item along the way.
+# This way we can report all duplicates without having to parse the files again.
+def index_items(key: str, parsed_files: Iterable[tuple[str, Mapping]]) -> ItemIndex:
+    items: dict[str, Any] = {}
+    sources: dict[str, list[str]] = {}
+    for file_name, parsed in parsed_files:
+        for name, item in parsed.get(key, {}).items():
+            sources.setdefault(name, []).append(file_name)
+            items.setdefault(name, item)
+    return ItemIndex(items=items, sources=sources)
+
+
+# Invert a collection of named items, each targeting a list of servers,
+# into one result per server holding all the items targeting that server.
+# The entries are tuples (item name, target servers, item) and build is called
+# once per server with the server name and its items, in order of appearance.
+# We fill the per-server dicts in place in a single pass over the items,
+# so that the work is linear in the number of (item, server) pairs.
+# Every server gets a shallow copy of the item, since the YAML dumper would
+# otherwise turn items shared between servers into anchors and aliases.
+def invert_server_items(
+    entries: Iterable[tuple[str, Iterable[str], Mapping]],
+    build: Callable[[str, Mapping[str, Mapping]], T],
+) -> list[T]:
+    server_items: dict[str, dict[str, Mapping]] = {}
+    for name, servers, item in entries:
+        for server in servers:
+            server_items.setdefault(server, {})[name] = dict(item)
+    return [build(server, items) for server, items in server_items.items()]
+
+
+# Apply fn to every item using up to jobs worker processes (defaulting to
+# the number of CPU cores), and return the results in the order of the items.
+# Only a few tasks per worker are in flight at any time, so that the pickled
+# copies of the arguments and results stay bounded in size.
+# fn needs to be picklable, so it should be a module-level function.
+def parallel_map(
+    fn: Callable[[A], T], items: Sequence[A], jobs: int | None = None
+) -> list[T]:
+    workers = min(jobs or os.cpu_count() or 1, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+
+    results: list[T] = []
+    pending: deque[Future[T]] = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= workers * PARALLEL_MAP_TASKS_PER_WORKER:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+
+# A compiled snapshot of the org-config JSON data, see open_snapshot.
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    connection: sqlite3.Connection
+
+    def __enter__(self) -> "ConfigSnapshot":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.connection.close()
+
+    # The record with the given name, e.g. the tunnel config of a single host.
+    def record(self, kind: str, name: str) -> Mapping | None:
+        row = self.connection.execute(
+            "SELECT json FROM records WHERE kind = ? AND name = ?", (kind, name)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # All records of the given kind, in the order of the JSON data.
+    def records(self, kind: str) -> Mapping[str, Mapping]:
+        return {
+            name: json.loads(record)
+            for name, record in self.connection.execute(
+                "SELECT name, json FROM records WHERE kind = ? ORDER BY position",
+                (kind,),
             )
+        }
+
+    # The whole merged JSON data of a source.
+    def document(self, source: str) -> Mapping:
+        row = self.connection.execute(
+            "SELECT json FROM documents WHERE source = ?", (source,)
+        ).fetchone()
+        if not row:
+            raise Exception(f"The config snapshot does not contain {source}.")
+        return json.loads(row[0])
+
 
-        # If the key is only present in one of the mappings, we use that value
-        if not (key in d1 and key in d2):
-            out[key] = d1.get(key, None) or d2.get(key, None)
-        # Otherwise, if the key maps to a mapping, we merge those mappings
-        elif isinstance(d1.get(key, None) or d2.get(key, None), Mapping):
-            out[key] = deep_merge(d1.get(key, {}), d2.get(key, {}))
-        # Otherwise, if the key maps to a list, we concat the lists
-        # (careful, str is a subset of Iterable!)
-        elif isinstance(d1.get(key, None) or d2.get(key, None), list):
-            out[key] = d1.get(key, []) + d2.get(key, [])
-        # If the key is present in both, but is twice None, then we can merge to None
-        elif d1.get(key, None) is None and d2.get(key, None) is None:
-            out[key] = None
-        # In other cases, we do not know what to do...
-        else:
-            raise ValueError(
-                f"Unmergeable type found during merge, key: '{key}', "
-                + f"type: '{type(d1.get(key, None) or d2.get(key, None))}'"
+# Digests of all files of the given sources, by source.
+def snapshot_digests(sources: Mapping[str, str]) -> Mapping[str, Mapping[str, str]]:
+    return {source: json_config_digests(path) for source, path in sources.items()}
+
+
+def read_snapshot_digests(snapshot_path: str) -> Mapping | None:
+    if not os.path.isfile(snapshot_path):
+        return None
+    try:
+        with closing(
+            sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+        ) as connection:
+            (version, digests) = connection.execute(
+                "SELECT version, digests FROM meta"
+            ).fetchone()
+    except (sqlite3.Error, TypeError):
+        return None
+    return json.loads(digests) if version == SNAPSHOT_VERSION else None
+
+
+# Compile the merged JSON data of the given sources into an SQLite database,
+# in which the records of every kind in SNAPSHOT_KINDS are indexed by name.
+# The database is written to a temporary file which then replaces the snapshot,
+# so that readers never see a partially written snapshot.
+def compile_snapshot(
+    snapshot_path: str,
+    sources: Mapping[str, str],
+    digests: Mapping[str, Mapping[str, str]],
+) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(snapshot_path)), suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        with closing(sqlite3.connect(tmp_path)) as connection, connection:
+            connection.executescript(
+                """
+                CREATE TABLE meta (version INTEGER NOT NULL, digests TEXT NOT NULL);
+                CREATE TABLE documents (source TEXT PRIMARY KEY, json TEXT NOT NULL);
+                CREATE TABLE records (
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    json TEXT NOT NULL,
+                    PRIMARY KEY (kind, name)
+                ) WITHOUT ROWID;
+                """
             )
+            connection.execute(
+                "INSERT INTO meta VALUES (?, ?)",
+                (SNAPSHOT_VERSION, json.dumps(digests, sort_keys=True)),
+            )
+            documents = {
+                source: read_json_configs(path) for source, path in sources.items()
+            }
+            connection.executemany(
+                "INSERT INTO documents VALUES (?, ?)",
+                [
+                    (source, json.dumps(document))
+                    for source, document in documents.items()
+                ],
+            )
+            for kind, (source, key_path) in SNAPSHOT_KINDS.items():
+                if source not in documents:
+                    continue
+                records = snapshot_records(documents[source], key_path, sources[source])
+                connection.executemany(
+                    "INSERT INTO records VALUES (?, ?, ?, ?)",
+                    [
+                        (kind, name, position, json.dumps(record))
+                        for position, (name, record) in enumerate(records)
+                    ],
+                )
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def snapshot_records(
+    document: Mapping, key_path: tuple[str, ...], source_path: str
+) -> Iterable[tuple[str, Any]]:
+    records: Any = document
+    for key in key_path:
+        records = records.get(key, {}) if isinstance(records, Mapping) else None
+    if not isinstance(records, Mapping):
+        raise Exception(
+            f"The value for key '{format_key_path(key_path)}' "
+            + f"in {source_path} should be a mapping."
+        )
+    return records.items()
+
+
+# Open the snapshot of the given sources, given as a mapping from
+# TUNNELS_SOURCE, USERS_SOURCE or KEYS_SOURCE to the path of a JSON file or
+# of a directory of JSON files.
+# The snapshot is recompiled whenever the digest of one of the source files
+# no longer matches, after which looking up a record only reads that record.
+def open_snapshot(
+    sources: Mapping[str, str], snapshot_path: str | None = None
+) -> ConfigSnapshot:
+    names = sorted(sources)
+    snapshot_path = snapshot_path or default_cache_file(
+        "-".join(["snapshot", *names]), ".sqlite", [sources[name] for name in names]
+    )
+    digests = snapshot_digests(sources)
+    if read_snapshot_digests(snapshot_path) != digests:
+        compile_snapshot(snapshot_path, sources, digests)
+    return ConfigSnapshot(sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True))
+
+
+# A cache of parsed YAML files, keyed by the digest of the content of the file
+# and the version of the loader, so that unchanged files do not need to be
+# parsed again, see open_parse_cache.
+# Only the least recently used max_entries files are kept.
+# Files that do not survive a round-trip through JSON are not cached.
+# The new entries and the keys of the hits are kept in memory and written in a
+# single transaction by commit, which runs when leaving the context, so that
+# a run does not pay for a commit, and its fsync, for every file.
+@dataclass(frozen=True)
+class ParseCache:
+    connection: sqlite3.Connection | None
+    max_entries: int
+    stats: dict[str, int] = field(default_factory=lambda: {"hits": 0, "misses": 0})
+    pending: dict[str, str] = field(default_factory=dict)
+    used: set[str] = field(default_factory=set)
+
+    def __enter__(self) -> "ParseCache":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        if self.connection:
+            self.commit()
+            self.connection.close()
+
+    # Parse the given YAML file. Files missing from the cache get validated
+    # with the given function before we store their parsed content in the cache.
+    def load(self, path: str, validate: Callable[[Any], None] | None = None) -> Any:
+        with open(path, "rb") as f:
+            content = f.read()
+        key = f"{parse_cache_loader()}:{hashlib.sha256(content).hexdigest()}"
+        cached = self.lookup(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return json.loads(cached)
+        self.stats["misses"] += 1
+        parsed = yaml_lib.safe_load(content)
+        if validate:
+            validate(parsed)
+        self.store(key, parsed)
+        return parsed
+
+    def lookup(self, key: str) -> str | None:
+        if not self.connection:
+            return None
+        if key in self.pending:
+            return self.pending[key]
+        row = self.connection.execute(
+            "SELECT json FROM parsed WHERE key = ?", (key,)
+        ).fetchone()
+        if row:
+            self.used.add(key)
+        return row[0] if row else None
 
-    return out
+    def store(self, key: str, parsed: Any) -> None:
+        if not self.connection:
+            return
+        try:
+            dumped = json.dumps(parsed)
+        except (TypeError, ValueError):
+            return
+        if json.loads(dumped) == parsed:
+            self.pending[key] = dumped
+
+    # Write the new entries, mark the hits as used at the time of the commit,
+    # and evict the least recently used entries beyond max_entries.
+    # Failing to update the cache only makes the next run slower.
+    def commit(self) -> None:
+        if not self.connection or not (self.pending or self.used):
+            return
+        now = time.time_ns()
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO parsed VALUES (?, ?, ?)",
+                    ((key, dumped, now) for key, dumped in self.pending.items()),
+                )
+                self.connection.executemany(
+                    "UPDATE parsed SET used = ? WHERE key = ?",
+                    ((now, key) for key in self.used),
+                )
+                self.connection.execute(
+                    "DELETE FROM parsed WHERE key NOT IN "
+                    + "(SELECT key FROM parsed ORDER BY used DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+        except sqlite3.Error as e:
+            print(f"WARNING: could not update the parse cache: {e}")
+        self.pending.clear()
+        self.used.clear()
+
+    def format_stats(self) -> str:
+        total = self.stats["hits"] + self.stats["misses"]
+        rate = self.stats["hits"] / total if total else 0
+        return (
+            f"Parse cache: {self.stats['hits']} hits, {self.stats['misses']} misses "
+            + f"({rate:.0%} hit rate)"
+        )
+
+
+# The version of the YAML loader, which is part of the keys of the parse cache,
+# since another loader could parse the same content differently.
+def parse_cache_loader() -> str:
+    return f"{PARSE_CACHE_VERSION}-{yaml.__version__}-{int(yaml_lib.LIBYAML)}"
+
+
+# Open the parse cache at the given path, creating it if needed.
+# Failing to open the cache only makes the run slower,
+# so we then parse all files without a cache.
+def open_parse_cache(
+    cache_path: str, max_entries: int = DEFAULT_PARSE_CACHE_SIZE
+) -> ParseCache:
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        connection = sqlite3.connect(cache_path, timeout=30)
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS parsed "
+                + "(key TEXT PRIMARY KEY, json TEXT NOT NULL, used INTEGER NOT NULL)"
+            )
+    except (OSError, sqlite3.Error) as e:
+        print(f"WARNING: could not open the parse cache {cache_path}: {e}")
+        return ParseCache(None, max_entries)
+    return ParseCache(connection, max_entries)
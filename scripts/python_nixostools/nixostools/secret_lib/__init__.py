@@ -1,7 +1,11 @@
+import hashlib
+import json
+import mmap
+import struct
+import zlib
 from base64 import b64decode
 from collections.abc import Mapping
-from textwrap import wrap
-from typing import Any
+from typing import Any, BinaryIO
 
 import nacl.utils
 from nacl.encoding import Base64Encoder, RawEncoder
@@ -19,6 +23,63 @@ OPENSSH_PUBLIC_KEY_SIGNATURE: bytes = b"\x00\x00\x00\x20"
 # Byte pattern anouncing the start of the actual private key bytes
 OPENSSH_PRIVATE_KEY_SIGNATURE: bytes = b"\x00\x00\x00\x40"
 
+# Parameters used to derive the key for keyed hashes from a password.
+# The salt is fixed, since the hashes need to be reproducible across runs.
+HASH_KEY_SALT: bytes = b"nixostools-keyed-hash"
+HASH_KEY_ITERATIONS: int = 600_000
+# Personalisation of the key of the state kept by decrypt_server_secrets
+STATE_KEY_PERSON: bytes = b"nixostools-state"
+
+# Layout of the indexed generated secrets file, see write_indexed_secrets
+INDEXED_SECRETS_MAGIC: bytes = b"OCBSECIX"
+INDEXED_SECRETS_VERSION: int = 1
+# magic, version, number of entries
+INDEXED_SECRETS_HEADER = struct.Struct("<8sII")
+# name offset, name length, record offset, record length
+INDEXED_SECRETS_ENTRY = struct.Struct("<QIQI")
+
+# Layout of the framed secrets payload, see encode_payload.
+# Payloads without this header are plain (padded) YAML, which can never start
+# with a NUL byte.
+PAYLOAD_MAGIC: bytes = b"\x00OCBP"
+PAYLOAD_VERSION: int = 1
+# magic, version, compression, length of the (compressed) content
+PAYLOAD_HEADER = struct.Struct("<5sBBI")
+PAYLOAD_COMPRESSION_NONE: str = "none"
+PAYLOAD_COMPRESSION_ZLIB: str = "zlib"
+PAYLOAD_COMPRESSIONS: Mapping[str, int] = {
+    PAYLOAD_COMPRESSION_NONE: 0,
+    PAYLOAD_COMPRESSION_ZLIB: 1,
+}
+
+# Keys of the envelope generated secrets file, see encrypt_server_secrets.
+# Host names cannot contain underscores, so the format key cannot clash with
+# the server names used as keys by the other formats.
+ENVELOPE_FORMAT_KEY: str = "_format"
+ENVELOPE_FORMAT: str = "envelope-1"
+ENVELOPE_SECRETS_KEY: str = "secrets"
+ENVELOPE_SERVERS_KEY: str = "servers"
+# Keys of a single server's record in the envelope format
+WRAPPED_KEYS_KEY: str = "wrapped_keys"
+ENCRYPTED_SECRETS_KEY: str = "encrypted_secrets"
+# Envelope payloads are padded to the next power of two, but at least this size
+ENVELOPE_MIN_PADDED_SIZE: int = 256
+# Keys used by the table of contents payload layout, see encrypt_server_secrets
+ENCRYPTED_ENTRIES_KEY: str = "encrypted_entries"
+TOC_ENTRY_KEY: str = "entry"
+
+# Layout of a stream-encrypted file, see encrypt_stream
+STREAM_MAGIC: bytes = b"OCBSTRM"
+STREAM_VERSION: int = 1
+# magic, version, size of the plaintext chunks
+STREAM_HEADER = struct.Struct("<7sBI")
+STREAM_CHUNK_SIZE: int = 64 * 1024
+STREAM_KEY_SIZE: int = nacl.bindings.crypto_secretstream_xchacha20poly1305_KEYBYTES
+# Keys of a binary secret whose content is stored in a stream-encrypted file
+BINARY_KEY: str = "binary"
+STREAM_FILE_KEY: str = "stream_file"
+STREAM_KEY_KEY: str = "stream_key"
+
 PUBLIC_KEY_LENGTH: int = nacl.bindings.crypto_box_PUBLICKEYBYTES
 PRIVATE_KEY_LENGTH: int = nacl.bindings.crypto_box_PUBLICKEYBYTES
 
@@ -32,9 +93,14 @@ PER_HOST_KEY = "per-host"
 PUBLIC_KEY_KEY = "public_key"
 
 
+# Base64 does not contain any whitespace or hyphens, so we can simply cut it into
+# lines of fixed width, which gives the same result as textwrap.wrap but is
+# a lot faster for large ciphertexts.
 def chunk(b64bytes: bytes) -> str:
-    wrapped = wrap(b64bytes.decode(UTF8), width=CHUNK_WIDTH)
-    return "\n".join(wrapped)
+    b64string = b64bytes.decode(UTF8)
+    return "\n".join(
+        b64string[i : i + CHUNK_WIDTH] for i in range(0, len(b64string), CHUNK_WIDTH)
+    )
 
 
 def generate_symmetric_key() -> bytes:
@@ -52,8 +118,150 @@ def encrypt_symmetric(key: bytes, bytes_to_encrypt: bytes) -> str:
 
 # Takes a b64-encoded string encrypted with the given shared key and decrypts it.
 def decrypt_symmetric(key: bytes, encrypted_secrets: str) -> str:
+    return decrypt_symmetric_bytes(key, encrypted_secrets).decode(UTF8)
+
+
+# The length of the plaintext of a string returned by encrypt_symmetric
+def symmetric_plaintext_length(encrypted_secrets: str) -> int:
+    return (
+        len(b64decode("".join(encrypted_secrets.split())))
+        - SecretBox.NONCE_SIZE
+        - SecretBox.MACBYTES
+    )
+
+
+def decrypt_symmetric_bytes(key: bytes, encrypted_secrets: str) -> bytes:
     box = SecretBox(key)
-    return decrypt(box, encrypted_secrets).decode(UTF8)
+    return decrypt(box, encrypted_secrets)
+
+
+# Encrypt everything read from source into sink, one chunk at a time, so that
+# the memory used does not depend on the size of the content.
+# The output consists of a header giving the chunk size, the secretstream header,
+# and then the encrypted chunks, the last one of which carries the final tag.
+# Every chunk, except the last one, holds exactly chunk_size bytes of content,
+# so that the reader knows where a chunk ends.
+def encrypt_stream(
+    key: bytes, source: BinaryIO, sink: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE
+) -> None:
+    state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+    header = nacl.bindings.crypto_secretstream_xchacha20poly1305_init_push(state, key)
+    sink.write(STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size))
+    sink.write(header)
+    # We read one chunk ahead, to know which chunk is the last one
+    current = source.read(chunk_size)
+    while True:
+        following = source.read(chunk_size) if len(current) == chunk_size else b""
+        tag = (
+            nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_MESSAGE
+            if following
+            else nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL
+        )
+        sink.write(
+            nacl.bindings.crypto_secretstream_xchacha20poly1305_push(
+                state, current, tag=tag
+            )
+        )
+        if not following:
+            return
+        current = following
+
+
+# The inverse of encrypt_stream.
+# Chunks that were modified, reordered, dropped or appended make this fail,
+# but the chunks before the failing one have already been written to sink.
+def decrypt_stream(key: bytes, source: BinaryIO, sink: BinaryIO) -> None:
+    header = source.read(STREAM_HEADER.size)
+    if len(header) != STREAM_HEADER.size:
+        raise Exception("The encrypted stream is truncated.")
+    (magic, version, chunk_size) = STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC or version != STREAM_VERSION:
+        raise Exception("The encrypted stream has an unsupported format.")
+    state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+    nacl.bindings.crypto_secretstream_xchacha20poly1305_init_pull(
+        state,
+        source.read(nacl.bindings.crypto_secretstream_xchacha20poly1305_HEADERBYTES),
+        key,
+    )
+    encrypted_chunk_size = (
+        chunk_size + nacl.bindings.crypto_secretstream_xchacha20poly1305_ABYTES
+    )
+    while True:
+        encrypted_chunk = source.read(encrypted_chunk_size)
+        (content, tag) = nacl.bindings.crypto_secretstream_xchacha20poly1305_pull(
+            state, encrypted_chunk
+        )
+        sink.write(content)
+        if tag == nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL:
+            if source.read(1):
+                raise Exception("The encrypted stream continues after its end.")
+            return
+        if len(encrypted_chunk) != encrypted_chunk_size:
+            raise Exception("The encrypted stream is truncated.")
+
+
+# Serialise the YAML text of a server's secrets into the payload that we encrypt.
+# Without compression, the payload is the plain UTF-8 encoded text, as understood
+# by all versions of decrypt_server_secrets. Otherwise, the payload starts with
+# a header giving the format version, the compression and the content length,
+# so that the content can be told apart from the padding that follows it.
+def encode_payload(text: str, compression: str | None = None) -> bytes:
+    content = text.encode(UTF8)
+    if not compression:
+        return content
+    if compression == PAYLOAD_COMPRESSION_ZLIB:
+        content = zlib.compress(content, level=9)
+    return (
+        PAYLOAD_HEADER.pack(
+            PAYLOAD_MAGIC,
+            PAYLOAD_VERSION,
+            PAYLOAD_COMPRESSIONS[compression],
+            len(content),
+        )
+        + content
+    )
+
+
+# The inverse of encode_payload, the padding is ignored.
+def decode_payload(payload: bytes) -> str:
+    if not payload.startswith(PAYLOAD_MAGIC):
+        return payload.decode(UTF8)
+    (_, version, compression, length) = PAYLOAD_HEADER.unpack_from(payload)
+    if version != PAYLOAD_VERSION:
+        raise Exception(f"Unsupported secrets payload version: {version}")
+    content = payload[PAYLOAD_HEADER.size : PAYLOAD_HEADER.size + length]
+    if compression == PAYLOAD_COMPRESSIONS[PAYLOAD_COMPRESSION_ZLIB]:
+        content = zlib.decompress(content)
+    elif compression != PAYLOAD_COMPRESSIONS[PAYLOAD_COMPRESSION_NONE]:
+        raise Exception(f"Unsupported secrets payload compression: {compression}")
+    return content.decode(UTF8)
+
+
+# Derive a key for keyed_hash from a password.
+def derive_hash_key(password: str) -> bytes:
+    return hashlib.pbkdf2_hmac(
+        "sha256", password.encode(UTF8), HASH_KEY_SALT, HASH_KEY_ITERATIONS
+    )
+
+
+# A keyed hash, which does not allow guessing the hashed content
+# for whoever does not know the key.
+def keyed_hash(key: bytes, bytes_to_hash: bytes) -> str:
+    return hashlib.blake2b(
+        bytes_to_hash, key=key[: hashlib.blake2b.MAX_KEY_SIZE]
+    ).hexdigest()
+
+
+# The key of the keyed hashes that a server keeps of its decrypted secrets,
+# derived from its private key, so that only the server can compute them.
+def derive_state_key(private_key: PrivateKey) -> bytes:
+    return hashlib.blake2b(
+        bytes(private_key), digest_size=32, person=STATE_KEY_PERSON
+    ).digest()
+
+
+def public_key_fingerprint(pubkey: PublicKey) -> str:
+    return hashlib.sha256(bytes(pubkey)).hexdigest()
 
 
 # takes a string of bytes and returns an encrypted version.
@@ -100,26 +308,32 @@ def extract_curve_private_key(priv_key: str) -> PrivateKey:
 def extract_public_key(
     tunnels_json: Mapping, server: str, public_keys_path: str
 ) -> PublicKey | None:
+    server_tunnel_data = tunnels_json[TUNNELS_KEY][PER_HOST_KEY].get(server)
+    if not server_tunnel_data:
+        raise Exception(f'Server {server} not found in "{public_keys_path}".')
+    return parse_openssh_public_key(server_tunnel_data[PUBLIC_KEY_KEY], server)
+
+
+# Parse an OpenSSH Ed25519 public key line, as found in the tunnels JSON data.
+# Returns None if the key is empty.
+def parse_openssh_public_key(openssh_public_key: str, server: str) -> PublicKey | None:
     def raise_wrong_format():
         raise Exception(
             f"Error parsing the public key for server {server}, wrong format."
         )
 
-    server_tunnel_data = tunnels_json[TUNNELS_KEY][PER_HOST_KEY].get(server)
-    if not server_tunnel_data:
-        raise Exception(f'Server {server} not found in "{public_keys_path}".')
-    if not server_tunnel_data[PUBLIC_KEY_KEY].strip():
+    if not openssh_public_key.strip():
         # The server is defined but has an empty public key
         # This happens for servers being provisioned
         return None
     # Find the public key, strip off the header,
     # and discard anything following the key
-    pubkey_split = server_tunnel_data[PUBLIC_KEY_KEY].split(maxsplit=2)
+    pubkey_split = openssh_public_key.split(maxsplit=2)
     if len(pubkey_split) < 2:
         raise_wrong_format()
     pubkey_chars = pubkey_split[1]
     if not len(pubkey_chars) == OPENSSH_PUBLIC_KEY_STRING_LENGTH:
-        raise_wrong_format
+        raise_wrong_format()
     return extract_curve_public_key(pubkey_chars)
 
 
@@ -127,3 +341,122 @@ def extract_public_key(
 def bytes_after(signature: bytes, length: int, bytestr: bytes) -> bytes:
     start = bytestr.find(signature) + len(signature)
     return bytestr[start : start + length]
+
+
+# Write the encrypted secrets of every server to an indexed file, so that a server
+# can read its own record without parsing the records of the whole fleet.
+# The file consists of a header, followed by a table of fixed-size entries
+# sorted by server name, and finally the server names and the records
+# (JSON-encoded) that the entries point to.
+# All integers are little-endian and the offsets are counted from the
+# start of the file.
+def write_indexed_secrets(output_path: str, records: Mapping[str, Mapping]) -> None:
+    encoded = sorted(
+        (name.encode(UTF8), json.dumps(record, sort_keys=True).encode(UTF8))
+        for name, record in records.items()
+    )
+    offset = INDEXED_SECRETS_HEADER.size + INDEXED_SECRETS_ENTRY.size * len(encoded)
+    entries = []
+    for name, record in encoded:
+        entries.append(
+            INDEXED_SECRETS_ENTRY.pack(
+                offset, len(name), offset + len(name), len(record)
+            )
+        )
+        offset += len(name) + len(record)
+
+    with open(output_path, "wb") as f:
+        f.write(
+            INDEXED_SECRETS_HEADER.pack(
+                INDEXED_SECRETS_MAGIC, INDEXED_SECRETS_VERSION, len(encoded)
+            )
+        )
+        f.writelines(entries)
+        for name, record in encoded:
+            f.write(name)
+            f.write(record)
+
+
+def is_indexed_secrets_file(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(INDEXED_SECRETS_MAGIC)) == INDEXED_SECRETS_MAGIC
+
+
+# Validate the header of an indexed secrets file and return the number of entries.
+def indexed_secrets_count(path: str, buf: mmap.mmap) -> int:
+    (magic, version, count) = INDEXED_SECRETS_HEADER.unpack_from(buf, 0)
+    if magic != INDEXED_SECRETS_MAGIC or version != INDEXED_SECRETS_VERSION:
+        raise Exception(f"The secrets file ({path}) has an unsupported format.")
+    return count
+
+
+# Return the name and the (still encoded) record of the i-th entry.
+def indexed_secrets_entry(buf: mmap.mmap, i: int) -> tuple[bytes, bytes]:
+    (name_offset, name_length, record_offset, record_length) = (
+        INDEXED_SECRETS_ENTRY.unpack_from(
+            buf, INDEXED_SECRETS_HEADER.size + i * INDEXED_SECRETS_ENTRY.size
+        )
+    )
+    return (
+        buf[name_offset : name_offset + name_length],
+        buf[record_offset : record_offset + record_length],
+    )
+
+
+# Look up the record of a single server, using a binary search over the entries.
+# Only the pages of the file that we actually touch get read from disk.
+def read_indexed_secrets(path: str, server_name: str) -> Mapping | None:
+    key = server_name.encode(UTF8)
+    with (
+        open(path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf,
+    ):
+        low, high = 0, indexed_secrets_count(path, buf)
+        while low < high:
+            mid = (low + high) // 2
+            (name, record) = indexed_secrets_entry(buf, mid)
+            if name == key:
+                return json.loads(record)
+            if name < key:
+                low = mid + 1
+            else:
+                high = mid
+    return None
+
+
+# Read the records of all servers.
+def read_all_indexed_secrets(path: str) -> Mapping[str, Mapping]:
+    with (
+        open(path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf,
+    ):
+        return {
+            name.decode(UTF8): json.loads(record)
+            for i in range(indexed_secrets_count(path, buf))
+            for (name, record) in [indexed_secrets_entry(buf, i)]
+        }
+
+
+# Pad a payload to the next power of two, with a minimum size.
+def pad_to_power_of_two(payload: bytes) -> bytes:
+    padded_len = max(ENVELOPE_MIN_PADDED_SIZE, 1 << (len(payload) - 1).bit_length())
+    return payload.ljust(padded_len, b"\n")
+
+
+def is_envelope_secrets(content: Mapping) -> bool:
+    return content.get(ENVELOPE_FORMAT_KEY) == ENVELOPE_FORMAT
+
+
+# Extract the record of a single server from an envelope secrets file:
+# the keys wrapped for this server and the secrets encrypted with them.
+def envelope_server_record(content: Mapping, server_name: str) -> Mapping | None:
+    wrapped_keys = content.get(ENVELOPE_SERVERS_KEY, {}).get(server_name)
+    if not wrapped_keys:
+        return None
+    encrypted_secrets = content[ENVELOPE_SECRETS_KEY]
+    return {
+        WRAPPED_KEYS_KEY: wrapped_keys,
+        ENCRYPTED_SECRETS_KEY: {
+            secret_id: encrypted_secrets[secret_id] for secret_id in wrapped_keys
+        },
+    }
@@ -6,7 +6,7 @@ from itertools import chain
 
 import requests
 
-from nixostools import ocb_nixos_lib
+from nixostools import keyring_lib
 
 
 def args_parser() -> argparse.ArgumentParser:
@@ -18,6 +18,14 @@ def args_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--tunnel_config_path", dest="tunnel_config_path", required=True
     )
+    parser.add_argument(
+        "--keyring_cache",
+        dest="keyring_cache",
+        required=False,
+        type=str,
+        help="path to the cache of the public keys compiled from the tunnel config, "
+        + "defaults to a file in the user's cache directory",
+    )
     parser.add_argument(
         "--dry_run", dest="dry_run", required=False, action="store_true"
     )
@@ -86,23 +94,24 @@ def add_key_to_github(
         )
 
 
-def get_keys_from_config(config_dir: str, tunnel_config_path: str) -> Mapping:
+def get_keys_from_config(
+    config_dir: str, tunnel_config_path: str, keyring_cache: str | None = None
+) -> Mapping:
     nixos_hosts = os.listdir(os.path.join(config_dir, "hosts"))
 
-    def is_eligible(host, tunnel_conf):
-        if f"{host}.nix" in nixos_hosts and tunnel_conf["public_key"]:
+    def is_eligible(host: str, host_key: keyring_lib.HostKey) -> bool:
+        if f"{host}.nix" in nixos_hosts and host_key.public_key:
             return True
         else:
             print(f"Ignoring host {host}, its configuration is not eligible")
             return False
 
-    tunnel_data = ocb_nixos_lib.read_json_configs(tunnel_config_path)
+    keyring = keyring_lib.load_keyring(tunnel_config_path, keyring_cache)
 
-    tunnel_confs = tunnel_data["tunnels"]["per-host"]
     response = {
-        host: {"key": tunnel_conf["public_key"]}
-        for (host, tunnel_conf) in tunnel_confs.items()
-        if is_eligible(host, tunnel_conf)
+        host: {"key": host_key.public_key}
+        for (host, host_key) in keyring.hosts.items()
+        if is_eligible(host, host_key)
     }
 
     print(f"Loaded {len(response.keys())} keys from the local config")
@@ -115,7 +124,7 @@ def main() -> None:
 
     gh_key_records = get_keys_from_github(session, args.api_token)
     cfg_key_records = get_keys_from_config(
-        args.nixos_config_dir, args.tunnel_config_path
+        args.nixos_config_dir, args.tunnel_config_path, args.keyring_cache
     )
     gh_titles = set(gh_key_records.keys())
     cfg_titles = set(cfg_key_records.keys())
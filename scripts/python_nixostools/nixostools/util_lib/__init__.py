@@ -1,6 +1,83 @@
+import dataclasses
+import grp
+import hashlib
+import json
 import os
+import pwd
+import shutil
+import stat
+import struct
+import tempfile
 import traceback
-from collections.abc import Mapping
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO
+
+UTF8 = "utf-8"
+STATE_VERSION = 2
+CHANGES_VERSION = 1
+
+# See acl(5) and the kernel's include/uapi/linux/posix_acl_xattr.h
+ACL_XATTR = "system.posix_acl_access"
+ACL_XATTR_VERSION = 2
+ACL_XATTR_HEADER = struct.Struct("<I")
+ACL_XATTR_ENTRY = struct.Struct("<HHI")
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+ACL_USER_OBJ = 0x01
+ACL_USER = 0x02
+ACL_GROUP_OBJ = 0x04
+ACL_GROUP = 0x08
+ACL_MASK = 0x10
+ACL_OTHER = 0x20
+ACL_TAGS = {
+    "u": ACL_USER_OBJ,
+    "user": ACL_USER_OBJ,
+    "g": ACL_GROUP_OBJ,
+    "group": ACL_GROUP_OBJ,
+    "m": ACL_MASK,
+    "mask": ACL_MASK,
+    "o": ACL_OTHER,
+    "other": ACL_OTHER,
+}
+
+# See renameat2(2)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+@dataclass(frozen=True)
+class AclEntry:
+    tag: int
+    qualifier: int
+    # Permissions in the format used by setfacl, e.g. "rwX" or "r-x"
+    perms: str
+
+    def bits(self, is_dir: bool) -> int:
+        return (
+            (4 if "r" in self.perms else 0)
+            | (2 if "w" in self.perms else 0)
+            | (1 if "x" in self.perms or ("X" in self.perms and is_dir) else 0)
+        )
+
+
+# The ownership and permissions that we give to every file and directory
+# that we create, instead of fixing them afterwards with chown and setfacl.
+@dataclass(frozen=True)
+class Permissions:
+    uid: int
+    gid: int
+    acl: tuple[AclEntry, ...]
+
+
+# The changes that sync_files made to the output directory,
+# by path relative to it, and the files that it failed to write.
+@dataclass(frozen=True)
+class FileChanges:
+    added: tuple[str, ...]
+    changed: tuple[str, ...]
+    removed: tuple[str, ...]
+    failed: tuple[str, ...]
 
 
 def is_default_extract(configuration: Mapping) -> bool:
@@ -13,21 +90,446 @@ def is_default_extract(configuration: Mapping) -> bool:
         return True
 
 
-def do_write_file(output_path: str, config_file: Mapping):
-    with open(output_path, "w") as f:
-        f.write(config_file["content"])
-        print(f"wrote {output_path}")
+# By default, we write the content of the configuration as text,
+# a write_content function can instead write anything to the binary file.
+# Since it can fail halfway, e.g. when decrypting a stream, its output goes to
+# a temporary file which only replaces the file once it has been written.
+def do_write_file(
+    output_path: str,
+    config_file: Mapping,
+    permissions: Permissions | None = None,
+    write_content: Callable[[BinaryIO, Mapping], None] | None = None,
+):
+    if write_content is None:
+        with open(output_path, "w") as f:
+            if permissions:
+                apply_permissions(f.fileno(), permissions, is_dir=False)
+            f.write(config_file["content"])
+    else:
+        tmp_path = temporary_path(output_path)
+        try:
+            with open(tmp_path, "wb") as bf:
+                if permissions:
+                    apply_permissions(bf.fileno(), permissions, is_dir=False)
+                write_content(bf, config_file)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+    print(f"wrote {output_path}")
+
+
+# A path next to the given one, to write the file before moving it into place.
+def temporary_path(output_path: str) -> str:
+    return os.path.join(
+        os.path.dirname(output_path), f".{os.path.basename(output_path)}.tmp"
+    )
+
+
+# Create the missing parent directories of a file below the given prefix.
+def make_parent_dirs(
+    output_path_prefix: str, relative_path: str, permissions: Permissions | None
+) -> None:
+    parent = os.path.dirname(os.path.normpath(relative_path))
+    if not parent:
+        return
+    directory = output_path_prefix
+    for part in parent.split(os.sep):
+        directory = os.path.join(directory, part)
+        if not os.path.isdir(directory):
+            os.mkdir(directory, mode=0o700)
+            if permissions:
+                apply_permissions_to_path(directory, permissions, is_dir=True)
 
 
+# Write the files of the configurations, carrying on after a file fails.
+# Returns the paths of the files that could not be written.
 def write_files(
-    output_path_prefix: str, configurations: Mapping, extract_all: bool = False
-):
+    output_path_prefix: str,
+    configurations: Mapping,
+    extract_all: bool = False,
+    permissions: Permissions | None = None,
+    write_content: Callable[[BinaryIO, Mapping], None] | None = None,
+) -> list[str]:
+    failed = []
     for configuration in configurations.values():
         if not extract_all and not is_default_extract(configuration):
             continue
         output_path = os.path.join(output_path_prefix, configuration["path"])
         try:
-            do_write_file(output_path, configuration)
+            make_parent_dirs(output_path_prefix, configuration["path"], permissions)
+            do_write_file(output_path, configuration, permissions, write_content)
         except Exception:
             print(f"ERROR : failed to write to {configuration['path']}")
             print(traceback.format_exc())
+            failed.append(configuration["path"])
+    return failed
+
+
+# Bring the output directory in line with the given configurations, without
+# touching the files that already have the right content: only new and changed
+# files get written, each atomically replacing the previous one, and files that
+# are no longer part of the configurations get removed.
+# Files whose content did not change only get their permissions fixed,
+# if these no longer match, as do the output directory and the existing
+# directories below it.
+def sync_files(
+    output_path_prefix: str,
+    configurations: Mapping,
+    extract_all: bool = False,
+    permissions: Permissions | None = None,
+) -> FileChanges:
+    wanted = {
+        os.path.normpath(configuration["path"]): configuration
+        for configuration in configurations.values()
+        if extract_all or is_default_extract(configuration)
+    }
+    existing = directory_digests(output_path_prefix)
+    if permissions:
+        for directory in sorted(existing_parent_dirs(output_path_prefix, wanted)):
+            fix_permissions(directory, permissions, is_dir=True)
+    added: list[str] = []
+    changed: list[str] = []
+    failed: list[str] = []
+    for path, configuration in sorted(wanted.items()):
+        output_path = os.path.join(output_path_prefix, path)
+        content = configuration["content"].encode(UTF8)
+        if existing.get(path) == hashlib.sha256(content).hexdigest():
+            if permissions:
+                fix_permissions(output_path, permissions, is_dir=False)
+            continue
+        try:
+            make_parent_dirs(output_path_prefix, path, permissions)
+            replace_file(output_path, content, permissions)
+        except Exception:
+            print(f"ERROR : failed to write to {configuration['path']}")
+            print(traceback.format_exc())
+            failed.append(path)
+            continue
+        (changed if path in existing else added).append(path)
+
+    removed = sorted(set(existing) - set(wanted))
+    for path in removed:
+        os.remove(os.path.join(output_path_prefix, path))
+        print(f"removed {os.path.join(output_path_prefix, path)}")
+        remove_empty_parent_dirs(output_path_prefix, path)
+    return FileChanges(
+        added=tuple(added),
+        changed=tuple(changed),
+        removed=tuple(removed),
+        failed=tuple(failed),
+    )
+
+
+# The output directory and the directories below it that already hold
+# some of the given paths.
+def existing_parent_dirs(output_path_prefix: str, paths: Iterable[str]) -> set[str]:
+    directories = {output_path_prefix}
+    for path in paths:
+        parent = os.path.dirname(path)
+        while parent:
+            directory = os.path.join(output_path_prefix, parent)
+            if os.path.isdir(directory):
+                directories.add(directory)
+            parent = os.path.dirname(parent)
+    return directories
+
+
+# Write the file next to its destination and then move it into place,
+# so that readers see either the previous or the new content.
+def replace_file(
+    output_path: str, content: bytes, permissions: Permissions | None
+) -> None:
+    tmp_path = temporary_path(output_path)
+    with open(tmp_path, "wb") as f:
+        if permissions:
+            apply_permissions(f.fileno(), permissions, is_dir=False)
+        f.write(content)
+    os.replace(tmp_path, output_path)
+    print(f"wrote {output_path}")
+
+
+# Write the file next to its destination and then move it into place, so that
+# readers see either the previous or the new content. The file gets created
+# with the given mode, so that it is never readable by more users than that.
+def write_file_atomically(path: str, content: bytes, mode: int = 0o644) -> None:
+    tmp_path = temporary_path(path)
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# Remove the parent directories of a removed file below the given prefix,
+# as long as they are empty.
+def remove_empty_parent_dirs(output_path_prefix: str, relative_path: str) -> None:
+    parent = os.path.dirname(relative_path)
+    while parent:
+        directory = os.path.join(output_path_prefix, parent)
+        if os.listdir(directory):
+            return
+        os.rmdir(directory)
+        parent = os.path.dirname(parent)
+
+
+# The default location of the changes manifest, next to the output directory.
+def default_changes_file(output_path: str) -> str:
+    return os.path.normpath(output_path) + ".changes.json"
+
+
+# Other units read the manifest, so we replace it atomically.
+def write_changes(changes_file: str, changes: FileChanges) -> None:
+    content = json.dumps(
+        {"version": CHANGES_VERSION, **dataclasses.asdict(changes)},
+        indent=2,
+        sort_keys=True,
+    )
+    write_file_atomically(changes_file, (content + "\n").encode(UTF8))
+
+
+# The sha256 of the file, or its keyed blake2b hash when given a key,
+# which does not allow guessing the content for whoever does not know the key.
+def file_digest(path: str, key: bytes | None = None) -> str:
+    with open(path, "rb") as f:
+        content = f.read()
+    if key is None:
+        return hashlib.sha256(content).hexdigest()
+    return hashlib.blake2b(content, key=key).hexdigest()
+
+
+# Digests of all files below the given directory, by path relative to it.
+def directory_digests(directory: str, key: bytes | None = None) -> Mapping[str, str]:
+    return {
+        os.path.relpath(os.path.join(root, name), directory): file_digest(
+            os.path.join(root, name), key
+        )
+        for root, _, names in os.walk(directory)
+        for name in names
+    }
+
+
+# Remove everything inside the given directory, but not the directory itself.
+def clear_directory(directory: str) -> None:
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+# The default location of the state file, next to the output directory,
+# so that it does not show up among the extracted files.
+def default_state_file(output_path: str) -> str:
+    return os.path.normpath(output_path) + ".state.json"
+
+
+# Digest identifying the input from which we extracted the files,
+# together with the options that influence which files get extracted.
+def input_digest(data: object, **options: object) -> str:
+    serialised = json.dumps({"data": data, "options": options}, sort_keys=True)
+    return hashlib.sha256(serialised.encode(UTF8)).hexdigest()
+
+
+# Check whether the output directory is still exactly as we left it
+# after extracting the given input.
+# The state holds keyed digests of the extracted files, since these can be
+# secrets, and the state file lives outside of the protected output directory.
+def is_unchanged(state_file: str, digest: str, output_path: str, key: bytes) -> bool:
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (
+        state.get("version") == STATE_VERSION
+        and state.get("input_digest") == digest
+        and state.get("files") == directory_digests(output_path, key)
+    )
+
+
+def write_state(state_file: str, digest: str, output_path: str, key: bytes) -> None:
+    state = {
+        "version": STATE_VERSION,
+        "input_digest": digest,
+        "files": directory_digests(output_path, key),
+    }
+    write_file_atomically(
+        state_file, json.dumps(state, sort_keys=True).encode(UTF8), mode=0o600
+    )
+
+
+def remove_state(state_file: str) -> None:
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+
+# Parse an owner ("user:group") and an ACL in the format used by setfacl
+# (e.g. "u::rwX,g::r-X,o::---,group:wheel:rX"), resolving user and group names.
+# Returns None if neither is given, a missing owner leaves the ownership unchanged.
+def parse_permissions(owner: str | None, acl: str | None) -> Permissions | None:
+    if not (owner or acl):
+        return None
+    (user, _, group) = (owner or "").partition(":")
+    return Permissions(
+        uid=pwd.getpwnam(user).pw_uid if user else -1,
+        gid=grp.getgrnam(group).gr_gid if group else -1,
+        acl=tuple(parse_acl_entry(entry) for entry in (acl or "").split(",") if entry),
+    )
+
+
+def parse_acl_entry(entry: str) -> AclEntry:
+    (tag, qualifier, perms) = entry.strip().split(":")
+    if tag not in ACL_TAGS:
+        raise ValueError(f"Unsupported ACL entry: {entry}")
+    if not qualifier:
+        return AclEntry(tag=ACL_TAGS[tag], qualifier=ACL_UNDEFINED_ID, perms=perms)
+    if ACL_TAGS[tag] == ACL_USER_OBJ:
+        return AclEntry(
+            tag=ACL_USER, qualifier=pwd.getpwnam(qualifier).pw_uid, perms=perms
+        )
+    if ACL_TAGS[tag] == ACL_GROUP_OBJ:
+        return AclEntry(
+            tag=ACL_GROUP, qualifier=grp.getgrnam(qualifier).gr_gid, perms=perms
+        )
+    raise ValueError(f"Unsupported ACL entry: {entry}")
+
+
+# Encode the ACL as the value of the system.posix_acl_access extended attribute.
+# Like setfacl, we add a mask entry granting the union of the permissions
+# of the group class when the ACL has named entries but no mask.
+def encode_acl(acl: tuple[AclEntry, ...], is_dir: bool) -> bytes:
+    entries = {(entry.tag, entry.qualifier): entry.bits(is_dir) for entry in acl}
+    has_named_entries = any(tag in (ACL_USER, ACL_GROUP) for (tag, _) in entries)
+    if has_named_entries and (ACL_MASK, ACL_UNDEFINED_ID) not in entries:
+        mask = 0
+        for (tag, _), bits in entries.items():
+            if tag in (ACL_USER, ACL_GROUP_OBJ, ACL_GROUP):
+                mask |= bits
+        entries[(ACL_MASK, ACL_UNDEFINED_ID)] = mask
+    return ACL_XATTR_HEADER.pack(ACL_XATTR_VERSION) + b"".join(
+        ACL_XATTR_ENTRY.pack(tag, bits, qualifier)
+        for (tag, qualifier), bits in sorted(entries.items())
+    )
+
+
+# The mode bits corresponding to the ACL, the group bits hold the mask if any.
+def acl_mode(acl: tuple[AclEntry, ...], is_dir: bool) -> int:
+    bits = {entry.tag: entry.bits(is_dir) for entry in acl}
+    return (
+        bits.get(ACL_USER_OBJ, 0) << 6
+        | bits.get(ACL_MASK, bits.get(ACL_GROUP_OBJ, 0)) << 3
+        | bits.get(ACL_OTHER, 0)
+    )
+
+
+def apply_permissions(fd: int, permissions: Permissions, is_dir: bool) -> None:
+    os.fchown(fd, permissions.uid, permissions.gid)
+    if permissions.acl:
+        os.fchmod(fd, acl_mode(permissions.acl, is_dir))
+        if any(entry.tag in (ACL_USER, ACL_GROUP) for entry in permissions.acl):
+            os.setxattr(fd, ACL_XATTR, encode_acl(permissions.acl, is_dir))
+
+
+# Check whether the file or directory already has the ownership and the ACL
+# that apply_permissions would give it.
+def has_permissions(path: str, permissions: Permissions, is_dir: bool = False) -> bool:
+    st = os.lstat(path)
+    if permissions.uid not in (-1, st.st_uid) or permissions.gid not in (-1, st.st_gid):
+        return False
+    if not permissions.acl:
+        return True
+    if any(entry.tag in (ACL_USER, ACL_GROUP) for entry in permissions.acl):
+        try:
+            return os.getxattr(path, ACL_XATTR) == encode_acl(permissions.acl, is_dir)
+        except OSError:
+            return False
+    return stat.S_IMODE(st.st_mode) == acl_mode(permissions.acl, is_dir)
+
+
+# Apply the permissions to the file or directory, unless it already has them.
+def fix_permissions(path: str, permissions: Permissions, is_dir: bool) -> None:
+    if not has_permissions(path, permissions, is_dir):
+        apply_permissions_to_path(path, permissions, is_dir)
+        print(f"fixed the permissions of {path}")
+
+
+def apply_permissions_to_path(path: str, permissions: Permissions, is_dir: bool):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if is_dir else 0))
+    try:
+        apply_permissions(fd, permissions, is_dir)
+    finally:
+        os.close(fd)
+
+
+# Atomically exchange two paths, returns False if the system does not support it.
+def exchange_paths(path1: str, path2: str) -> bool:
+    # Imported here, since only --atomic needs it and it is slow to import
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, "renameat2", None)
+    if renameat2 is None:
+        return False
+    result = renameat2(
+        AT_FDCWD, os.fsencode(path1), AT_FDCWD, os.fsencode(path2), RENAME_EXCHANGE
+    )
+    return result == 0
+
+
+# Move the new directory into place. Afterwards, the path of the new directory
+# holds the previous content of the target, if there was any.
+def replace_directory(new_directory: str, target: str) -> None:
+    if not os.path.lexists(target):
+        os.rename(new_directory, target)
+    elif not exchange_paths(new_directory, target):
+        # Fall back to a (non-atomic) sequence of renames
+        old_directory = new_directory + ".old"
+        os.rename(target, old_directory)
+        os.rename(new_directory, target)
+        os.rename(old_directory, new_directory)
+
+
+# Yield a fresh staging directory, next to the output directory, to write the
+# files into. When the block finishes without errors, the staging directory
+# atomically replaces the output directory, so that services never see
+# a partially written output directory.
+@contextmanager
+def staged_directory(
+    output_path: str, permissions: Permissions | None = None
+) -> Iterator[str]:
+    target = os.path.normpath(output_path)
+    staging = tempfile.mkdtemp(
+        prefix=f".{os.path.basename(target)}.staging-", dir=os.path.dirname(target)
+    )
+    try:
+        if permissions:
+            apply_permissions_to_path(staging, permissions, is_dir=True)
+        elif os.path.isdir(target):
+            shutil.copymode(target, staging)
+        yield staging
+        replace_directory(staging, target)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+
+# Write the files into a staging directory which then replaces the output
+# directory. If any file fails, the previous output directory stays in place.
+def write_files_atomically(
+    output_path: str,
+    configurations: Mapping,
+    extract_all: bool = False,
+    permissions: Permissions | None = None,
+    write_content: Callable[[BinaryIO, Mapping], None] | None = None,
+) -> None:
+    with staged_directory(output_path, permissions) as staging:
+        failed = write_files(
+            staging, configurations, extract_all, permissions, write_content
+        )
+        if failed:
+            raise Exception(
+                f"Failed to write {', '.join(failed)}, "
+                + f"keeping the previous content of {output_path}."
+            )
@@ -0,0 +1,90 @@
+import re
+from collections.abc import Mapping
+from typing import Any
+
+import yaml
+
+# Whether PyYAML was built with the libyaml bindings
+LIBYAML: bool = getattr(yaml, "__with_libyaml__", False)
+
+# The libyaml emitter does not always give the same output as the pure-Python one,
+# e.g. it wraps double-quoted strings differently and ends documents whose
+# last scalar is a literal block keeping its trailing line breaks with "...".
+# Strings made of these characters never need quoting with escapes,
+# so that both emitters give the same output for them.
+# This covers the base64 ciphertexts and the host names making up the bulk
+# of the generated files.
+LIBYAML_SAFE_STRING = re.compile(r"[A-Za-z0-9+/=_.\n-]*")
+
+
+# Represent multiline strings as literal blocks, which keeps app configs readable.
+def str_presenter(dumper, data):
+    if len(data.splitlines()) > 1:  # check for multiline string
+        return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
+    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+
+
+class LiteralSafeDumper(yaml.SafeDumper):
+    pass
+
+
+LiteralSafeDumper.add_representer(str, str_presenter)
+
+if LIBYAML:
+
+    class LiteralCSafeDumper(yaml.CSafeDumper):
+        pass
+
+    LiteralCSafeDumper.add_representer(str, str_presenter)
+
+
+def safe_load(stream: Any, libyaml: bool = LIBYAML) -> Any:
+    loader = yaml.CSafeLoader if libyaml and LIBYAML else yaml.SafeLoader
+    return yaml.load(stream, Loader=loader)
+
+
+# A drop-in replacement for yaml.safe_dump, which uses the libyaml emitter
+# whenever it gives exactly the same output as the pure-Python one.
+# With literal=True, multiline strings are represented as literal blocks.
+def safe_dump(
+    data: Any,
+    stream: Any = None,
+    literal: bool = False,
+    libyaml: bool = LIBYAML,
+    **kwargs: Any,
+) -> Any:
+    use_libyaml = (
+        libyaml and LIBYAML and is_libyaml_safe(data, kwargs.get("default_style"))
+    )
+    dumper: type
+    if literal:
+        dumper = LiteralCSafeDumper if use_libyaml else LiteralSafeDumper
+    else:
+        dumper = yaml.CSafeDumper if use_libyaml else yaml.SafeDumper
+    return yaml.dump(data, stream, Dumper=dumper, **kwargs)
+
+
+# Check whether the libyaml emitter gives the same output as the pure-Python one.
+# With a default style, only strings are safe, since the emitters tag the other
+# scalars differently.
+def is_libyaml_safe(data: Any, default_style: str | None = None) -> bool:
+    if isinstance(data, str):
+        return (
+            LIBYAML_SAFE_STRING.fullmatch(data) is not None
+            and not data.endswith("\n\n")
+            and data != "\n"
+        )
+    elif isinstance(data, Mapping):
+        return all(
+            isinstance(key, str)
+            and key != ""
+            and is_libyaml_safe(key, default_style)
+            and is_libyaml_safe(value, default_style)
+            for key, value in data.items()
+        )
+    elif isinstance(data, list):
+        return all(is_libyaml_safe(item, default_style) for item in data)
+    elif default_style:
+        return False
+    else:
+        return data is None or isinstance(data, bool | int)